@@ -0,0 +1,248 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cvm
+import schema
+import storage
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cvm')
+# Uma empresa por segmento, em anos com lacunas no database.csv: cobertura de juros sem despesa
+# financeira (FCA), giro de fornecedores (FCA, MOVIDA, LOG-IN) e ROI sem investimentos (FCA, LOG-IN)
+SAMPLES = {
+  'ARTERIS S.A.': (2021, 2022),
+  'FERROVIA CENTRO-ATLANTICA S.A.': (2013, 2014),
+  'LOG-IN LOGISTICA INTERMODAL S.A.': (2020, 2021),
+  'MOVIDA PARTICIPACOES SA': (2019, 2020),
+}
+# Casos do formato que o pipeline tem que tratar: DFC publicado em reais, DFP reapresentada (versão 2,
+# com uma linha da versão 1 que tem que ser descartada) e DRE individual que perde para o consolidado
+IN_REAIS = ('ARTERIS S.A.', 2021)
+RESTATED = ('ARTERIS S.A.', 2022)
+
+DESCRIPTIONS = {
+  '1': 'Ativo Total',
+  '1.01': 'Ativo Circulante',
+  '1.01.03': 'Contas a Receber',
+  '1.01.04': 'Estoques',
+  '1.02.02': 'Investimentos',
+  '2': 'Passivo Total',
+  '2.01': 'Passivo Circulante',
+  '2.01.02': 'Fornecedores',
+  '2.02': 'Passivo Não Circulante',
+  '2.03': 'Patrimônio Líquido Consolidado',
+  '3.01': 'Receita de Venda de Bens e/ou Serviços',
+  '3.02': 'Custo dos Bens e/ou Serviços Vendidos',
+  '3.03': 'Resultado Bruto',
+  '3.04': 'Despesas/Receitas Operacionais',
+  '3.05': 'Resultado Antes do Resultado Financeiro e dos Tributos',
+  '3.06.02': 'Despesas Financeiras',
+  '3.11': 'Lucro/Prejuízo Consolidado do Período',
+  '6.01': 'Caixa Líquido Atividades Operacionais',
+  '6.03.05': 'Dividendos e Juros sobre o Capital Próprio Pagos',
+}
+STATEMENTS = {
+  '1': ('BPA', 'Balanço Patrimonial Ativo'),
+  '2': ('BPP', 'Balanço Patrimonial Passivo'),
+  '3': ('DRE', 'Demonstração do Resultado'),
+  '6': ('DFC_MI', 'Demonstração do Fluxo de Caixa (Método Indireto)'),
+}
+HEADER = ['CNPJ_CIA', 'DT_REFER', 'VERSAO', 'DENOM_CIA', 'CD_CVM', 'GRUPO_DFP', 'MOEDA', 'ESCALA_MOEDA', 'ORDEM_EXERC', 'DT_INI_EXERC', 'DT_FIM_EXERC', 'CD_CONTA', 'DS_CONTA', 'VL_CONTA', 'ST_CONTA_FIXA']
+
+
+def year_accounts(data):
+  # Contas de cada empresa-ano que reproduzem os indicadores do database.csv. Saem em milhares de
+  # reais inteiros, ou frações de 1/12 nos saldos médios, a menos do ruído das 10 casas dos índices;
+  # arredondar devolve o valor publicado
+  def snap(values):
+    rounded = np.round(values * 12) / 12
+    return np.where(np.abs(values - rounded) < 0.01, rounded, values) + 0
+  get = lambda column : data[column].to_numpy(dtype=np.float64)
+  revenue, cost, pc, elp, pl = get('RECEITA LIQUIDA'), get('CUSTO DA MERCADORIA VENDIDA'), get('PASSIVO CIRCULANTE'), get('EXIGIVEL A LONGO PRAZO'), get('PATRIMONIO LIQUIDO')
+  liabilities = pc + elp
+  net = snap(get('MG_LIQ') * revenue)
+  financial = snap(get('JUROS') * liabilities / 2)
+  index = pd.MultiIndex.from_arrays([data['DENOM_CIA'].astype(str), data['DT_FIM_EXERC'].astype(int)])
+  accounts = pd.DataFrame({
+    '1': liabilities + pl,
+    '1.01': get('ATIVO CIRCULANTE'),
+    '1.02.02': net / get('ROI'),
+    '2': liabilities + pl,
+    '2.01': pc,
+    '2.02': elp,
+    '2.03': pl,
+    '3.01': revenue,
+    '3.02': cost,
+    '3.03': revenue + cost,
+    '3.04': get('DESPESAS OPERACIONAIS %') * revenue,
+    '3.05': get('MG_OP') * revenue,
+    '3.06.02': financial,
+    '3.11': net,
+    # Sem despesa financeira os dois índices de cobertura são lacuna e o caixa operacional não aparece
+    '6.01': get('COBERTURA DE JUROS (CAIXA OPERAÇÕES)') * financial,
+    '6.03.05': -get('PAYOUT') * net,
+  }, index=index).apply(snap)
+  averages = pd.DataFrame({
+    '1.01.03': revenue / get('GIRO DE VALORES A RECEBER'),
+    '1.01.04': get('ATIVO CIRCULANTE') - get('LIQUIDEZ A SECO') * pc,
+    '2.01.02': cost / get('GIRO DE DUPLICATAS A PAGAR'),
+  }, index=index).apply(snap)
+  return accounts, averages
+
+
+def split_average(averages):
+  # O DFP de um ano traz o saldo do ano (ÚLTIMO) e o do anterior (PENÚLTIMO); a média é dos dois.
+  # Encadeia os anos: o PENÚLTIMO de um ano é o ÚLTIMO do anterior. O primeiro saldo de cada trecho
+  # é a menor das duas primeiras médias, para nenhum dos dois primeiros anos ficar negativo
+  current, previous = {}, {}
+  last = None
+  for year, value in averages.items():
+    if np.isnan(value):
+      last = None
+      continue
+    if last is None:
+      following = averages.get(year + 1, np.nan)
+      current[year] = value if np.isnan(following) else min(value, following)
+    else:
+      current[year] = 2 * value - last
+    previous[year] = 2 * value - current[year]
+    last = current[year]
+  return current, previous
+
+
+def statement_rows(data, companies=None):
+  # Linhas no formato dos arquivos da CVM, empresa-ano por empresa-ano, nos intervalos de companies
+  # (padrão: todos os anos de cada empresa)
+  accounts, averages = year_accounts(data)
+  if companies is None:
+    companies = {company: (years.min(), years.max()) for company, years in data.groupby(data['DENOM_CIA'].astype(str))['DT_FIM_EXERC']}
+  rows = []
+  for company, (first, last) in companies.items():
+    years = [year for year in accounts.loc[company].index if first <= year <= last]
+    balances = {code: split_average(averages.loc[company, code].loc[years]) for code in averages.columns}
+    for year in years:
+      for order, source in (('ÚLTIMO', year), ('PENÚLTIMO', year - 1)):
+        values = accounts.loc[(company, source)].dropna().to_dict() if (company, source) in accounts.index else {}
+        for code, (current, previous) in balances.items():
+          if year in current: values[code] = current[year] if order == 'ÚLTIMO' else previous[year]
+        rows.extend({'DENOM_CIA': company, 'ANO': year, 'ORDEM_EXERC': order, 'CD_CONTA': code, 'VL_CONTA': value} for code, value in sorted(values.items()))
+  rows = pd.DataFrame(rows)
+  names = sorted(data['DENOM_CIA'].astype(str).unique())
+  # Códigos CVM e CNPJ fictícios
+  rows = rows.assign(CD_CVM=rows['DENOM_CIA'].map({name: 90001 + i for i, name in enumerate(names)}), ESCALA_MOEDA='MIL', VERSAO=1, ESCOPO='con')
+
+  # Os casos de formato, quando a empresa-ano está entre as linhas
+  company, year = IN_REAIS
+  reais = (rows['DENOM_CIA'] == company) & (rows['ANO'] == year) & rows['CD_CONTA'].str.startswith('6')
+  rows.loc[reais, 'ESCALA_MOEDA'] = 'UNIDADE'
+  rows.loc[reais, 'VL_CONTA'] *= 1000
+  company, year = RESTATED
+  restated = (rows['DENOM_CIA'] == company) & (rows['ANO'] == year)
+  rows.loc[restated, 'VERSAO'] = 2
+  net = restated & (rows['CD_CONTA'] == '3.11') & (rows['ORDEM_EXERC'] == 'ÚLTIMO')
+  stale = rows[net].assign(VERSAO=1, VL_CONTA=rows.loc[net, 'VL_CONTA'] * 2)
+  individual = rows[restated & rows['CD_CONTA'].str.startswith('3')].assign(ESCOPO='ind', VL_CONTA=lambda frame : frame['VL_CONTA'] / 2)
+  return pd.concat([rows, stale, individual], ignore_index=True)
+
+
+def write_statements(rows, directory):
+  rows = rows.assign(STATEMENT=rows['CD_CONTA'].str[0])
+  for (statement, year, scope), part in rows.groupby(['STATEMENT', 'ANO', 'ESCOPO']):
+    name, group = STATEMENTS[statement]
+    part = part.sort_values(['CD_CVM', 'ORDEM_EXERC', 'CD_CONTA'], ascending=[True, False, True], kind='stable')
+    period = part['ANO'] - (part['ORDEM_EXERC'] == 'PENÚLTIMO')
+    frame = pd.DataFrame({
+      'CNPJ_CIA': '00.000.000/0001-00',
+      'DT_REFER': f'{year}-12-31',
+      'VERSAO': part['VERSAO'],
+      'DENOM_CIA': part['DENOM_CIA'],
+      'CD_CVM': part['CD_CVM'],
+      'GRUPO_DFP': f'DF {"Consolidado" if scope == "con" else "Individual"} - {group}',
+      'MOEDA': 'REAL',
+      'ESCALA_MOEDA': part['ESCALA_MOEDA'],
+      'ORDEM_EXERC': part['ORDEM_EXERC'],
+      'DT_INI_EXERC': period.astype(str) + '-01-01',
+      'DT_FIM_EXERC': period.astype(str) + '-12-31',
+      'CD_CONTA': part['CD_CONTA'],
+      'DS_CONTA': part['CD_CONTA'].map(DESCRIPTIONS),
+      'VL_CONTA': part['VL_CONTA'].map('{:.10f}'.format),
+      'ST_CONTA_FIXA': np.where(part['CD_CONTA'].str.count(r'\.') < 2, 'S', 'N'),
+    }, columns=HEADER)
+    # Balanços não têm início de exercício
+    if name in ('BPA', 'BPP'): frame = frame.drop(columns='DT_INI_EXERC')
+    frame.to_csv(os.path.join(directory, f'dfp_cia_aberta_{name}_{scope}_{year}.csv'), sep=';', encoding='latin-1', index=False, lineterminator='\r\n')
+
+
+def compare(result, expected):
+  # Todas as colunas do database.csv, empresa-ano a empresa-ano
+  order = ['DENOM_CIA', 'DT_FIM_EXERC']
+  expected = expected.sort_values(order).reset_index(drop=True)
+  result = result.sort_values(order).reset_index(drop=True)
+  assert (result[order].astype(str).to_numpy() == expected[order].astype(str).to_numpy()).all(), 'empresas/anos diferentes'
+  assert (result['TIPO'].astype(str).to_numpy() == expected['TIPO'].astype(str).to_numpy()).all(), 'segmentos diferentes'
+  worst = {}
+  for column in schema.indicator_columns():
+    a, b = result[column].to_numpy(dtype=np.float64), expected[column].to_numpy(dtype=np.float64)
+    assert (np.isnan(a) == np.isnan(b)).all(), f'lacunas diferentes em {column}'
+    valid = ~np.isnan(a)
+    worst[column] = float((np.abs(a[valid] - b[valid]) / np.maximum(np.abs(b[valid]), 1e-12)).max()) if valid.any() else 0.0
+    assert worst[column] < 1e-8, f'{column}: desvio relativo {worst[column]:.2e}'
+  return max(worst.values()), max(worst, key=worst.get)
+
+
+def check_chunks(files, chunksize):
+  # Com blocos pequenos as linhas de uma mesma empresa-ano caem em blocos diferentes: a leitura em
+  # blocos tem que dar o mesmo que a leitura do arquivo inteiro
+  split = 0
+  for path in files:
+    rows = pd.read_csv(path, sep=';', encoding='latin-1', usecols=['CD_CVM', 'DT_REFER'])
+    split += int((rows.groupby(['CD_CVM', 'DT_REFER']).size() > chunksize).sum())
+    chunked, whole = cvm.reduce_file(path, chunksize), cvm.reduce_file(path, len(rows) + 1)
+    pd.testing.assert_frame_equal(chunked.astype(str), whole.astype(str))
+  assert split > 0, f'nenhuma empresa-ano passa de {chunksize} linhas num arquivo'
+  return split
+
+
+def run_pipeline(directory, workers, chunksize):
+  with tempfile.TemporaryDirectory() as output:
+    path = os.path.join(output, 'database.csv')
+    cvm.run([directory], path, workers, chunksize, segments=cvm.known_segments())
+    return storage.parse_csv(path)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Confere o cvm.py: os demonstrativos de exemplo (e os de todas as empresas-ano) têm que reproduzir o database.csv')
+  parser.add_argument('--workers', type=int, default=os.cpu_count())
+  parser.add_argument('--chunksize', type=int, default=4, help='linhas por bloco; pequeno para dividir empresas-ano entre blocos')
+  parser.add_argument('--write', action='store_true', help='regrava os arquivos de exemplo a partir do database.csv')
+  args = parser.parse_args()
+
+  data = storage.load_data()
+  if args.write:
+    shutil.rmtree(FIXTURE_PATH, ignore_errors=True)
+    os.makedirs(FIXTURE_PATH)
+    write_statements(statement_rows(data, SAMPLES), FIXTURE_PATH)
+
+  # Amostra versionada: uma empresa por segmento
+  files = cvm.statement_files([FIXTURE_PATH])
+  split = check_chunks(files, args.chunksize)
+  samples = pd.concat([data[(data['DENOM_CIA'] == company) & data['DT_FIM_EXERC'].between(first, last)] for company, (first, last) in SAMPLES.items()])
+  deviation, column = compare(run_pipeline(FIXTURE_PATH, args.workers, args.chunksize), samples)
+  print(f'amostras/cvm: {len(files)} arquivos, {split} empresas-ano divididas entre blocos de {args.chunksize} linhas; '
+        f'{len(samples)} empresas-ano reproduzidas, maior desvio relativo {deviation:.2e} ({column})')
+
+  # Todas as empresas-ano do database.csv, com as contas montadas do mesmo jeito
+  with tempfile.TemporaryDirectory() as directory:
+    write_statements(statement_rows(data), directory)
+    deviation, column = compare(run_pipeline(directory, args.workers, 200_000), data)
+  print(f'database.csv: {len(data)} empresas-ano reproduzidas, maior desvio relativo {deviation:.2e} ({column})')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,299 @@
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+
+import cube
+import gaps
+import schema
+import storage
+
+# Nível 1: cinco vezes mais rápido que o 6 numa série grande, com corpo só ~8% maior
+GZIP_LEVEL = 1
+
+STATUS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 431: 'Request Header Fields Too Large', 500: 'Internal Server Error'}
+
+
+def columnar(frame):
+  # Uma lista por coluna; NaN e infinitos viram null
+  data = {}
+  for name, series in frame.items():
+    if pd.api.types.is_float_dtype(series.dtype):
+      values = series.to_numpy(dtype=np.float64)
+      column = values.astype(object)
+      column[~np.isfinite(values)] = None
+      data[str(name)] = column.tolist()
+    else:
+      data[str(name)] = series.astype(object).where(series.notna(), None).tolist()
+  return {'linhas': len(frame), 'colunas': list(data), 'dados': data}
+
+
+def param(params, name, default=None, convert=str):
+  if name not in params: return default
+  try:
+    return convert(params[name][-1])
+  except ValueError:
+    raise ValueError(f'Parâmetro inválido: {name}={params[name][-1]}')
+
+
+class Snapshot:
+  # Dados, cubo e versão de um mesmo instante; cada requisição usa um só, mesmo que os dados mudem no meio
+  def __init__(self, state, data, aggregation):
+    self.state = state
+    self.version = storage.dataset_version(state)
+    self.data = data
+    self.cube = aggregation
+    self.columns = schema.indicator_columns()
+    self.min_year = int(data['DT_FIM_EXERC'].min())
+    self.max_year = int(data['DT_FIM_EXERC'].max())
+
+  def filters(self, params):
+    category = param(params, 'segmento')
+    min_year = param(params, 'inicio', self.min_year, int)
+    max_year = param(params, 'fim', self.max_year, int)
+    # Intervalo invertido é erro do cliente; fora dos anos da base só devolve listas vazias
+    if min_year > max_year: raise ValueError(f'inicio ({min_year}) maior que fim ({max_year})')
+    companies = params.get('empresa', [])
+    return category, min_year, max_year, companies
+
+  def indicators(self, params, default):
+    columns = params.get('coluna', default)
+    unknown = [column for column in columns if column not in self.columns]
+    if unknown: raise ValueError(f'Colunas desconhecidas: {unknown}')
+    return list(dict.fromkeys(columns))
+
+  def select(self, params):
+    category, min_year, max_year, companies = self.filters(params)
+    rows = storage.select_rows(self.data, category, min_year, max_year, companies=companies)
+    return schema.remove_unused_categories(self.data.take(rows))
+
+  def series(self, params):
+    columns = self.indicators(params, self.columns)
+    return columnar(self.select(params)[['DENOM_CIA', 'TIPO', 'DT_FIM_EXERC', *columns]])
+
+  def aggregates(self, params):
+    name = param(params, 'funcao', 'Média')
+    func = cube.AGG_MAP.get(name, name)
+    if func not in cube.AGG_MAP.values(): raise ValueError(f'Função desconhecida: {name} (use {list(cube.AGG_MAP)})')
+    columns = self.indicators(params, self.columns)
+    category, min_year, max_year, companies = self.filters(params)
+    return columnar(self.cube.aggregate(columns, func, min_year, max_year, category=category, companies=companies))
+
+  def gaps(self, params):
+    # Padrão: a tabela de empresas sem investimento (ROI ausente) da aba RETORNO
+    columns = self.indicators(params, ['ROI'])
+    table = gaps.find_gaps(self.select(params), columns)
+    return columnar(table[['INDICADOR', 'DENOM_CIA', 'INICIO', 'FIM', 'PERIODO']])
+
+  def info(self, params):
+    return {
+      'versao': self.version,
+      'segmentos': [str(category) for category in self.data['TIPO'].cat.categories],
+      'anos': [self.min_year, self.max_year],
+      'colunas': self.columns,
+      'funcoes': cube.AGG_MAP,
+    }
+
+
+ROUTES = {
+  '/series': Snapshot.series,
+  '/agregados': Snapshot.aggregates,
+  '/lacunas': Snapshot.gaps,
+  '/versao': Snapshot.info,
+}
+
+
+class ResponseCache:
+  # Corpos prontos (JSON e gzip) por rota, parâmetros e versão dos dados
+  def __init__(self, max_entries=512):
+    self.max_entries = max_entries
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.entries.move_to_end(key)
+      return entry
+
+  def put(self, key, entry):
+    with self.lock:
+      self.entries[key] = entry
+      while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def stats(self):
+    with self.lock:
+      return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class ApiServer:
+  def __init__(self, csv_path=storage.CSV_PATH, store_path=storage.STORE_PATH, cache_size=512, refresh=1.0):
+    self.csv_path = csv_path
+    self.store_path = store_path
+    self.refresh_interval = refresh
+    self.cache = ResponseCache(cache_size)
+    # Requisições iguais que chegam juntas esperam o mesmo cálculo
+    self.pending = {}
+    self.snapshot = None
+    self.reloading = None
+    self.checked = 0
+    self.reload_lock = asyncio.Lock()
+
+  def load(self):
+    # Mesmo caminho do dashboard: colunas compartilhadas e cubo refeito só se o CSV base mudar.
+    # Os deltas entram numa cópia do cubo: o snapshot anterior segue servindo com o cubo dele até
+    # a troca, e dados, cubo e versão de um snapshot são sempre do mesmo instante
+    state = storage.dataset_state(self.csv_path, self.store_path)
+    if self.snapshot is not None and storage.dataset_version(state) == self.snapshot.version: return self.snapshot
+    data = storage.load_shared(self.csv_path, self.store_path)
+    previous = self.snapshot
+    if previous is not None and previous.state['sha256'] == state['sha256']:
+      aggregation = previous.cube.copy()
+      aggregation.sync(data, len(state['deltas']), lambda start : storage.load_deltas(start, self.store_path))
+    else:
+      aggregation = cube.AggregationCube(data, schema.indicator_columns(), version=len(state['deltas']))
+    self.cache.clear()
+    return Snapshot(state, data, aggregation)
+
+  async def reload(self):
+    async with self.reload_lock:
+      self.snapshot = await asyncio.get_running_loop().run_in_executor(None, self.load)
+      self.checked = time.monotonic()
+
+  async def current(self):
+    # Só a primeira requisição espera os dados. Depois, a checagem de dados novos roda em segundo
+    # plano e as requisições seguem com o snapshot atual até o novo ficar pronto
+    if self.snapshot is None:
+      await self.reload()
+    elif time.monotonic() - self.checked >= self.refresh_interval and (self.reloading is None or self.reloading.done()):
+      self.checked = time.monotonic()
+      self.reloading = asyncio.get_running_loop().create_task(self.reload())
+    return self.snapshot
+
+  def render(self, snapshot, route, params):
+    body = json.dumps(ROUTES[route](snapshot, params), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return body, gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+  async def respond(self, method, target, headers):
+    if method not in ('GET', 'HEAD'): return 405, {}, None
+    url = urlsplit(target)
+    if url.path not in ROUTES: return 404, {}, {'erro': f'Rota desconhecida: {url.path}', 'rotas': list(ROUTES)}
+    params = parse_qs(url.query)
+    snapshot = await self.current()
+
+    key = (url.path, tuple(sorted((name, tuple(values)) for name, values in params.items())), snapshot.version)
+    etag = '"' + hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:20] + '"'
+    cache_headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+    if etag in headers.get('if-none-match', ''): return 304, cache_headers, None
+
+    entry = self.cache.get(key)
+    if entry is None:
+      future = self.pending.get(key)
+      if future is None:
+        future = self.pending[key] = asyncio.get_running_loop().run_in_executor(None, self.render, snapshot, url.path, params)
+        future.add_done_callback(lambda _ : self.pending.pop(key, None))
+      try:
+        entry = await asyncio.shield(future)
+      except (ValueError, KeyError) as error:
+        return 400, {}, {'erro': str(error).strip("'")}
+      self.cache.put(key, entry)
+
+    body, compressed = entry
+    if 'gzip' in headers.get('accept-encoding', ''):
+      return 200, {**cache_headers, 'Content-Encoding': 'gzip'}, compressed
+    return 200, cache_headers, body
+
+  async def handle(self, reader, writer):
+    try:
+      while True:
+        try:
+          head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.LimitOverrunError:
+          await self.send(writer, 431, {}, {'erro': 'Cabeçalho grande demais'}, False, 'GET')
+          break
+        except (asyncio.IncompleteReadError, ConnectionError):
+          break
+
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+          method, target, protocol = lines[0].split(' ', 2)
+        except ValueError:
+          await self.send(writer, 400, {}, {'erro': 'Requisição malformada'}, False, 'GET')
+          break
+        headers = {}
+        for line in lines[1:]:
+          name, _, value = line.partition(':')
+          if name: headers[name.strip().lower()] = value.strip()
+        # GET não tem corpo, mas um cliente pode mandar; descarta para não quebrar a conexão
+        if headers.get('content-length', '0').isdigit() and int(headers.get('content-length', '0')):
+          await reader.readexactly(int(headers['content-length']))
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' if protocol == 'HTTP/1.1' else connection == 'keep-alive'
+
+        try:
+          status, extra, body = await self.respond(method, target, headers)
+        except Exception as error:
+          status, extra, body = 500, {}, {'erro': f'{type(error).__name__}: {error}'}
+        await self.send(writer, status, extra, body, keep_alive, method)
+        if not keep_alive: break
+    except ConnectionError:
+      pass
+    finally:
+      writer.close()
+
+  async def send(self, writer, status, headers, body, keep_alive, method):
+    if isinstance(body, dict): body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+    body = body or b''
+    head = [f'HTTP/1.1 {status} {STATUS[status]}', f'Content-Length: {len(body)}', f'Connection: {"keep-alive" if keep_alive else "close"}']
+    if status != 304: head.append('Content-Type: application/json; charset=utf-8')
+    head.extend(f'{name}: {value}' for name, value in headers.items())
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+    if method != 'HEAD' and status != 304: writer.write(body)
+    await writer.drain()
+
+  async def serve(self, host='127.0.0.1', port=8502, ready=None):
+    await self.current()
+    server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+    if ready is not None: ready(server)
+    async with server:
+      await server.serve_forever()
+
+
+def main():
+  parser = argparse.ArgumentParser(description='API HTTP local com as séries, agregados e lacunas do dashboard em JSON colunar')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8502)
+  parser.add_argument('--csv', default=storage.CSV_PATH)
+  parser.add_argument('--store', default=storage.STORE_PATH)
+  parser.add_argument('--cache', type=int, default=512, help='respostas guardadas em memória')
+  parser.add_argument('--refresh', type=float, default=1.0, help='segundos entre as checagens de dados novos')
+  args = parser.parse_args()
+
+  server = ApiServer(args.csv, args.store, args.cache, args.refresh)
+  ready = lambda listening : print(f'API em http://{args.host}:{listening.sockets[0].getsockname()[1]} (rotas: {", ".join(ROUTES)})', flush=True)
+  try:
+    asyncio.run(server.serve(args.host, args.port, ready))
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  main()
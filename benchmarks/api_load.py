@@ -0,0 +1,158 @@
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import schema
+import storage
+
+API_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api.py')
+
+
+def percentile(values, fraction):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+async def fetch(reader, writer, path, etag=None):
+  lines = [f'GET {path} HTTP/1.1', 'Host: localhost', 'Accept-Encoding: gzip']
+  if etag: lines.append(f'If-None-Match: {etag}')
+  writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+  head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+  headers = {name.strip().lower(): value.strip() for name, _, value in (line.partition(':') for line in head[1:] if line)}
+  body = await reader.readexactly(int(headers.get('content-length', 0)))
+  return int(head[0].split()[1]), headers.get('etag'), body
+
+
+async def fetch_info(port):
+  reader, writer = await asyncio.open_connection('127.0.0.1', port)
+  try:
+    _, _, body = await fetch(reader, writer, '/versao')
+    return json.loads(gzip.decompress(body))
+  finally:
+    writer.close()
+
+
+def build_queries(info, count, seed):
+  # Consultas do tipo que o dashboard faz: segmento e intervalo de anos, colunas de uma aba
+  rng = random.Random(seed)
+  groups = [columns for columns in schema.get_groups().values() if columns]
+  first, last = info['anos']
+  queries = set()
+  while len(queries) < count:
+    start = rng.randint(first, last)
+    params = [('segmento', rng.choice(info['segmentos'])), ('inicio', start), ('fim', rng.randint(start, last))]
+    params += [('coluna', column) for column in rng.choice(groups)]
+    route = rng.choice(['/series', '/agregados', '/agregados', '/lacunas'])
+    if route == '/agregados': params.append(('funcao', rng.choice(list(info['funcoes']))))
+    if route == '/lacunas': params = params[:3]
+    queries.add(f'{route}?{urlencode(params)}')
+  return sorted(queries)
+
+
+async def run_phase(port, clients, jobs, etags):
+  # jobs: lista de caminhos distribuída entre os clientes, cada um com uma conexão keep-alive
+  latencies, sizes, statuses = [], [], {}
+  queue = iter(jobs)
+
+  async def client():
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+      for path in queue:
+        start = time.perf_counter()
+        status, etag, body = await fetch(reader, writer, path, etags.get(path) if etags is not None else None)
+        latencies.append(time.perf_counter() - start)
+        sizes.append(len(body))
+        statuses[status] = statuses.get(status, 0) + 1
+        if etag: known[path] = etag
+    finally:
+      writer.close()
+
+  known = {}
+  start = time.perf_counter()
+  await asyncio.gather(*(client() for _ in range(clients)))
+  elapsed = time.perf_counter() - start
+  return {
+    'requests': len(latencies),
+    'seconds': elapsed,
+    'throughput': len(latencies) / elapsed,
+    'p50_ms': percentile(latencies, 0.5) * 1000,
+    'p99_ms': percentile(latencies, 0.99) * 1000,
+    'max_ms': max(latencies) * 1000,
+    'kib': sum(sizes) / len(sizes) / 1024,
+    'status': statuses,
+  }, known
+
+
+async def bench(port, clients, requests, queries, seed):
+  rng = random.Random(seed)
+  results = {}
+  # frio: cada consulta distinta uma vez, cache vazio; quente: as mesmas, repetidas ao acaso;
+  # revalidação: o cliente manda o ETag e recebe 304 sem corpo
+  results['frio'], etags = await run_phase(port, clients, list(queries), None)
+  hot = [rng.choice(queries) for _ in range(clients * requests)]
+  results['quente'], _ = await run_phase(port, clients, hot, None)
+  results['revalidação'], _ = await run_phase(port, clients, hot, etags)
+  return results
+
+
+def start_server(csv_path, store_path):
+  process = subprocess.Popen([sys.executable, API_PATH, '--port', '0', '--csv', csv_path, '--store', store_path], stdout=subprocess.PIPE, text=True)
+  line = process.stdout.readline()
+  if not line:
+    process.wait()
+    raise RuntimeError('A API não subiu')
+  return process, int(line.split('http://')[1].split()[0].rsplit(':', 1)[1])
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Mede vazão e latência (p50/p99) da API com muitos clientes simultâneos')
+  parser.add_argument('--csv', default=None, help='base a servir (padrão: a maior de benchmarks/data ou o database.csv)')
+  parser.add_argument('--clients', type=int, nargs='+', default=[100, 200])
+  parser.add_argument('--requests', type=int, default=20, help='requisições por cliente nas fases quente e de revalidação')
+  parser.add_argument('--queries', type=int, default=300, help='consultas distintas')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', default=None, help='grava os resultados em JSON')
+  args = parser.parse_args()
+
+  csv_path = args.csv
+  if csv_path is None:
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+    candidates = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.csv')] if os.path.isdir(directory) else []
+    csv_path = max(candidates, key=os.path.getsize) if candidates else storage.CSV_PATH
+
+  runs = []
+  with tempfile.TemporaryDirectory() as tmp:
+    store_path = os.path.join(tmp, 'database.parquet')
+    print(f'{csv_path} ({os.path.getsize(csv_path) / 2 ** 20:.1f} MiB)')
+    print(f'{"clientes":>8} {"fase":<12} {"req":>6} {"req/s":>8} {"p50 ms":>8} {"p99 ms":>8} {"máx ms":>8} {"KiB":>7}  status')
+    for clients in args.clients:
+      # Um servidor novo por nível de concorrência, para a fase fria começar de cache vazio
+      process, port = start_server(csv_path, store_path)
+      try:
+        info = asyncio.run(fetch_info(port))
+        queries = build_queries(info, args.queries, args.seed)
+        results = asyncio.run(bench(port, clients, args.requests, queries, args.seed))
+      finally:
+        process.terminate()
+        process.wait()
+      for phase, result in results.items():
+        status = ' '.join(f'{code}:{count}' for code, count in sorted(result['status'].items()))
+        print(f'{clients:>8} {phase:<12} {result["requests"]:>6} {result["throughput"]:>8.0f} {result["p50_ms"]:>8.1f} {result["p99_ms"]:>8.1f} {result["max_ms"]:>8.1f} {result["kib"]:>7.1f}  {status}')
+      runs.append({'clients': clients, 'phases': results})
+
+  if args.output:
+    with open(args.output, 'w', encoding='utf-8') as file:
+      json.dump({'csv': csv_path, 'queries': args.queries, 'runs': runs}, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+  main()
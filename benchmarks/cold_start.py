@@ -0,0 +1,54 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import storage
+
+
+def legacy_get_data(path):
+  data = pd.read_csv(path).sort_values(by='DT_FIM_EXERC')
+  for column in data.columns[data.dtypes == object]:
+    if column in ('DENOM_CIA', 'TIPO'): continue
+    data[column] = pd.to_numeric(data[column].str.replace(',', '.'))
+  return data
+
+
+def measure(fn, repeat):
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    timings.append(time.perf_counter() - start)
+  return min(timings), sum(timings) / len(timings)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Compara o cold start do CSV com o armazenamento colunar')
+  parser.add_argument('--csv', default=storage.CSV_PATH)
+  parser.add_argument('--repeat', type=int, default=10)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as tmp:
+    store_path = os.path.join(tmp, 'database.parquet')
+    start = time.perf_counter()
+    storage.build_store(args.csv, store_path)
+    ingest = time.perf_counter() - start
+
+    results = {
+      'csv + str.replace (atual)': measure(lambda: legacy_get_data(args.csv), args.repeat),
+      'csv decimal=","': measure(lambda: storage.parse_csv(args.csv), args.repeat),
+      'parquet': measure(lambda: storage.load_data(args.csv, store_path), args.repeat),
+    }
+
+  print(f'ingestão única: {ingest * 1000:.1f} ms')
+  for name, (best, mean) in results.items():
+    print(f'{name:<28} melhor {best * 1000:8.2f} ms   média {mean * 1000:8.2f} ms')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,70 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import schema
+import storage
+
+
+def generate(companies, years, seed=0, first_year=2000, reference=None):
+  # Gera um CSV no mesmo esquema do database.csv, com médias, dispersões, segmentos e
+  # taxas de lacunas tirados da base real
+  if reference is None: reference = storage.load_data()
+  manifest = schema.get_manifest()
+  rng = np.random.default_rng(seed)
+
+  company = np.repeat(np.arange(companies), years)
+  year = np.tile(np.arange(first_year, first_year + years), companies)
+  segments = reference['TIPO'].astype(str).unique()
+  data = {
+    'DENOM_CIA': np.char.add('EMPRESA SINTETICA ', np.char.zfill(np.arange(companies).astype(str), 6))[company],
+    'TIPO': segments[rng.integers(len(segments), size=companies)][company],
+    'DT_FIM_EXERC': year,
+  }
+
+  gap_companies = reference.groupby('DENOM_CIA', observed=True).agg(lambda values: values.isna().any()).mean()
+  for column, kind in manifest.items():
+    if kind not in ('valor', 'indice'): continue
+    values = reference[column].dropna()
+    level = rng.normal(values.mean(), values.std() or 1, size=companies)[company]
+    series = level * rng.normal(1, 0.1, size=len(company))
+
+    if gap_companies.get(column, 0) > 0:
+      # Lacunas em blocos contíguos de anos, como no ROI da base real
+      with_gap = rng.random(companies) < gap_companies[column]
+      start = rng.integers(years, size=companies)
+      length = rng.integers(1, years + 1, size=companies)
+      offset = year - first_year
+      missing = with_gap[company] & (offset >= start[company]) & (offset < (start + length)[company])
+      series = np.where(missing, np.nan, series)
+
+    if kind == 'valor':
+      # Valores são inteiros; com lacunas a coluna fica float com NaN, como o apply_schema lê
+      series = np.round(series)
+      if not np.isnan(series).any(): series = series.astype(np.int64)
+    data[column] = series
+  return pd.DataFrame(data, columns=list(manifest))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Gera bases sintéticas no formato do database.csv')
+  parser.add_argument('--companies', type=int, nargs='+', default=[100, 5000])
+  parser.add_argument('--years', type=int, default=25)
+  parser.add_argument('--output', default=os.path.join('benchmarks', 'data'))
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  os.makedirs(args.output, exist_ok=True)
+  reference = storage.load_data()
+  for companies in args.companies:
+    path = os.path.join(args.output, f'database_{companies}x{args.years}.csv')
+    storage.write_csv(generate(companies, args.years, seed=args.seed, reference=reference), path)
+    print(f'{path}: {companies * args.years} linhas, {os.path.getsize(path) / 1024 / 1024:.1f} MiB')
+
+
+if __name__ == '__main__':
+  main()
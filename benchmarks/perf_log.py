@@ -0,0 +1,30 @@
+import argparse
+import json
+import os
+import statistics
+
+
+def percentile(values, fraction):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Resume o desempenho.jsonl: latência por interação em reruns completos e em fragmentos')
+  parser.add_argument('log', nargs='?', default=os.environ.get('BOVESPA_PERF_LOG', './desempenho.jsonl'))
+  args = parser.parse_args()
+
+  groups = {}
+  with open(args.log, encoding='utf-8') as file:
+    for line in file:
+      entry = json.loads(line)
+      key = (entry.get('kind', 'rerun'), entry.get('fragment') or entry.get('metric'))
+      groups.setdefault(key, []).append(entry['total_ms'])
+
+  print(f'{"tipo":<10} {"bloco":<28} {"n":>5} {"mediana ms":>11} {"p95 ms":>9}')
+  for (kind, name), values in sorted(groups.items()):
+    print(f'{kind:<10} {str(name):<28} {len(values):>5} {statistics.median(values):>11.1f} {percentile(values, 0.95):>9.1f}')
+
+
+if __name__ == '__main__':
+  main()
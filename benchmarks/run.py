@@ -0,0 +1,136 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import charts
+import cube
+import schema
+import storage
+
+AGG_FUNCTIONS = ['sum', 'mean', 'min', 'max', 'median', 'std']
+
+
+def measure(fn, repeat):
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = fn()
+    timings.append(time.perf_counter() - start)
+  return result, min(timings)
+
+
+def filter_data(data, segment, min_year, max_year, companies):
+  base = data[data['TIPO'] == segment]
+  base = base[(base['DT_FIM_EXERC'] >= min_year) & (base['DT_FIM_EXERC'] <= max_year)]
+  if companies: base = base[base['DENOM_CIA'].isin(companies)]
+  return schema.remove_unused_categories(base)
+
+
+def bench_file(csv_path, repeat, figure_companies):
+  results = []
+  record = lambda stage, seconds, **extra : results.append({'stage': stage, 'seconds': seconds, **extra})
+
+  with tempfile.TemporaryDirectory() as tmp:
+    store_path = os.path.join(tmp, 'database.parquet')
+    _, seconds = measure(lambda: storage.parse_csv(csv_path), repeat)
+    record('get_data csv', seconds)
+    _, seconds = measure(lambda: storage.build_store(csv_path, store_path), 1)
+    record('get_data ingest', seconds)
+    data, seconds = measure(lambda: storage.load_data(csv_path, store_path), repeat)
+    record('get_data parquet', seconds)
+
+  segment = data['TIPO'].value_counts().index[0]
+  min_year, max_year = int(data['DT_FIM_EXERC'].min()), int(data['DT_FIM_EXERC'].max())
+  base, seconds = measure(lambda: filter_data(data, segment, min_year, max_year, None), repeat)
+  record('sidebar filter segment', seconds, rows=len(base))
+  selected = list(base['DENOM_CIA'].unique()[:10])
+  _, seconds = measure(lambda: filter_data(data, segment, min_year, max_year, selected), repeat)
+  record('sidebar filter companies', seconds)
+
+  aggregation_cube, seconds = measure(lambda: cube.AggregationCube(data, schema.indicator_columns()), 1)
+  record('cube build', seconds)
+
+  # As figuras usam no máximo figure_companies empresas; px.line com milhares de traces não representa uso real
+  plotted = base[base['DENOM_CIA'].isin(base['DENOM_CIA'].unique()[:figure_companies])]
+  plotted = schema.remove_unused_categories(plotted)
+  for tab, columns in schema.get_groups().items():
+    if not columns: continue
+    for func in AGG_FUNCTIONS:
+      _, seconds = measure(lambda: base.groupby('DENOM_CIA', observed=True).agg({column: func for column in columns}), repeat)
+      record('groupby agg', seconds, tab=tab, function=func)
+      # O cubo guarda em cache median/std; limpa para medir o cálculo, não o acerto de cache
+      aggregation_cube.clear_cache()
+      _, seconds = measure(lambda: aggregation_cube.aggregate(columns, func, min_year, max_year, category=segment), repeat)
+      record('cube agg', seconds, tab=tab, function=func)
+
+    for column in columns:
+      pivot, seconds = measure(lambda: base.pivot(index='DENOM_CIA', columns='DT_FIM_EXERC', values=[column]), repeat)
+      record('heatmap pivot', seconds, tab=tab, column=column, bytes=charts.figure_size(charts.heatmap_figure(pivot, column)))
+      # Segmento inteiro dentro do orçamento de células (top-N + "Outras")
+      (matrix, omitted, _), seconds = measure(lambda: charts.heatmap_matrix(base, column), repeat)
+      record('heatmap budget', seconds, tab=tab, column=column, omitted=omitted)
+      fig, seconds = measure(lambda: charts.heatmap_figure(matrix, column), repeat)
+      record('figure heatmap budget', seconds, tab=tab, column=column, bytes=charts.figure_size(fig))
+      small_pivot = plotted.pivot(index='DENOM_CIA', columns='DT_FIM_EXERC', values=[column])
+      _, seconds = measure(lambda: charts.heatmap_figure(small_pivot, column), repeat)
+      record('figure heatmap', seconds, tab=tab, column=column)
+      _, seconds = measure(lambda: charts.line_figure(plotted, column, y=column), repeat)
+      record('figure line', seconds, tab=tab, column=column)
+      means = aggregation_cube.aggregate([column], 'mean', min_year, max_year, category=segment, companies=plotted['DENOM_CIA'].unique())
+      _, seconds = measure(lambda: charts.column_figure(means, column, y=column), repeat)
+      record('figure column', seconds, tab=tab, column=column)
+
+  meta = {
+    'csv': csv_path,
+    'rows': len(data),
+    'companies': int(data['DENOM_CIA'].nunique()),
+    'years': max_year - min_year + 1,
+    'segment': segment,
+    'segment_rows': len(base),
+    'figure_companies': int(plotted['DENOM_CIA'].nunique()),
+  }
+  return meta, results
+
+
+def summarize(meta, results):
+  totals = {}
+  for result in results:
+    totals[result['stage']] = totals.get(result['stage'], 0) + result['seconds']
+  print(f"\n{meta['csv']} ({meta['rows']} linhas, {meta['companies']} empresas, segmento {meta['segment']}: {meta['segment_rows']} linhas)")
+  for stage, seconds in totals.items():
+    print(f'  {stage:<26} {seconds * 1000:10.2f} ms')
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Mede os pontos quentes do dashboard em bases sintéticas')
+  parser.add_argument('csv', nargs='*', help='bases a medir (padrão: benchmarks/data/*.csv e o database.csv)')
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--figure-companies', type=int, default=200)
+  parser.add_argument('--output', default='bench_output.json')
+  args = parser.parse_args()
+
+  paths = args.csv or sorted(glob.glob(os.path.join('benchmarks', 'data', '*.csv'))) + [storage.CSV_PATH]
+  runs = []
+  for path in paths:
+    meta, results = bench_file(path, args.repeat, args.figure_companies)
+    summarize(meta, results)
+    runs.append({**meta, 'results': results})
+
+  with open(args.output, 'w', encoding='utf-8') as file:
+    json.dump({
+      'python': platform.python_version(),
+      'machine': platform.machine(),
+      'repeat': args.repeat,
+      'runs': runs,
+    }, file, ensure_ascii=False, indent=2)
+  print(f'\nresultados em {args.output}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,120 @@
+import argparse
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import schema
+import storage
+
+
+def memory(pid='self'):
+  # RSS conta as páginas do arquivo mapeado em cada processo; PSS divide as compartilhadas
+  info = {}
+  with open(f'/proc/{pid}/status') as file:
+    for line in file:
+      if line.startswith('VmRSS:'): info['rss'] = int(line.split()[1]) / 1024
+  if os.path.exists(f'/proc/{pid}/smaps_rollup'):
+    with open(f'/proc/{pid}/smaps_rollup') as file:
+      for line in file:
+        if line.startswith('Pss:'): info['pss'] = int(line.split()[1]) / 1024
+  return info
+
+
+def session(data, index):
+  # Um usuário: escolhe um segmento e um intervalo de anos, agrega e segura o recorte
+  segments = data['TIPO'].cat.categories
+  years = data['DT_FIM_EXERC']
+  min_year, max_year = int(years.min()), int(years.max())
+  segment = segments[index % len(segments)]
+  base = schema.remove_unused_categories(data.take(storage.select_rows(data, segment, min_year + index % 3, max_year)))
+  means = base.groupby('DENOM_CIA', observed=True)[schema.indicator_columns()].mean()
+  return base, means
+
+
+def child(mode, csv_path, store_path, counts):
+  # Simulação num processo só, como as sessões de um mesmo servidor Streamlit: cada modo roda num
+  # processo novo para que um não herde as páginas do outro
+  shared = storage.load_shared(csv_path, store_path)
+  frozen = pickle.dumps(storage.load_data(csv_path, store_path)) if mode == 'copy' else None
+  sessions = []
+  for count in counts:
+    while len(sessions) < count:
+      # copy: o st.cache_data devolve uma cópia desserializada a cada sessão
+      data = pickle.loads(frozen) if mode == 'copy' else shared
+      sessions.append((data, session(data, len(sessions))))
+    info = memory()
+    print(f'{mode:<7} {count:>9} {info["rss"]:>10.1f} {info.get("pss", float("nan")):>10.1f}', flush=True)
+
+
+def worker(mode, csv_path, store_path, index):
+  # Um processo de verdade (como os do report.py ou vários servidores da api.py): carrega, atende
+  # uma sessão, avisa o pai e fica vivo segurando tudo até o pai fechar o stdin
+  data = storage.load_data(csv_path, store_path) if mode == 'copy' else storage.load_shared(csv_path, store_path)
+  held = session(data, index)
+  print('pronto', flush=True)
+  sys.stdin.read()
+  return held
+
+
+def processes(mode, csv_path, store_path, count):
+  # N processos vivos ao mesmo tempo; a soma dos PSS é a memória que eles ocupam juntos no host
+  command = [sys.executable, os.path.abspath(__file__), '--mode', mode, '--worker', '--csv', csv_path, '--store', store_path]
+  children = [subprocess.Popen([*command, '--sessions', str(index)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True) for index in range(count)]
+  try:
+    for process in children:
+      if process.stdout.readline().strip() != 'pronto': raise RuntimeError(f'processo {process.pid} falhou')
+    infos = [memory(process.pid) for process in children]
+  finally:
+    for process in children:
+      process.stdin.close()
+      process.wait()
+  rss = sum(info['rss'] for info in infos)
+  pss = sum(info.get('pss', float('nan')) for info in infos)
+  print(f'{mode:<7} {count:>10} {rss:>10.1f} {pss:>10.1f}', flush=True)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Mede a memória com N sessões num processo e com N processos simultâneos: cópia contra colunas mapeadas')
+  parser.add_argument('--csv', default=None, help='base a medir (padrão: a maior de benchmarks/data ou o database.csv)')
+  parser.add_argument('--sessions', type=int, nargs='+', default=[1, 5, 10, 20, 50], help='sessões simuladas num processo só')
+  parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4, 8], help='processos simultâneos, cada um com uma sessão')
+  parser.add_argument('--mode', choices=['copy', 'shared'], help=argparse.SUPPRESS)
+  parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+  parser.add_argument('--store', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.mode and args.worker:
+    worker(args.mode, args.csv, args.store, args.sessions[0])
+    return
+  if args.mode:
+    child(args.mode, args.csv, args.store, args.sessions)
+    return
+
+  csv_path = args.csv
+  if csv_path is None:
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+    candidates = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.csv')] if os.path.isdir(directory) else []
+    csv_path = max(candidates, key=os.path.getsize) if candidates else storage.CSV_PATH
+
+  with tempfile.TemporaryDirectory() as tmp:
+    store_path = os.path.join(tmp, 'database.parquet')
+    storage.build_store(csv_path, store_path)
+    storage.load_shared(csv_path, store_path)
+    print(f'{csv_path} ({os.path.getsize(csv_path) / 2 ** 20:.1f} MiB)')
+    print('Sessões simuladas num processo (memória do processo)')
+    print(f'{"modo":<7} {"sessões":>9} {"RSS MiB":>10} {"PSS MiB":>10}')
+    for mode in ('copy', 'shared'):
+      command = [sys.executable, os.path.abspath(__file__), '--mode', mode, '--csv', csv_path, '--store', store_path, '--sessions', *map(str, args.sessions)]
+      subprocess.run(command, check=True)
+    print('Processos simultâneos (soma de todos os processos; PSS divide as páginas compartilhadas)')
+    print(f'{"modo":<7} {"processos":>10} {"RSS MiB":>10} {"PSS MiB":>10}')
+    for mode in ('copy', 'shared'):
+      for count in args.processes:
+        processes(mode, csv_path, store_path, count)
+
+
+if __name__ == '__main__':
+  main()
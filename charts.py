@@ -0,0 +1,258 @@
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+import plotly.io as pio
+from plotly.subplots import make_subplots
+
+# Ordenação por semelhança no mapa de calor é opcional: só com o scipy instalado
+try:
+  from scipy.cluster.hierarchy import leaves_list, linkage
+except ImportError:
+  linkage = None
+CLUSTERING = linkage is not None
+
+# Células (empresa x ano) enviadas por mapa de calor; acima disso as empresas de menor
+# estatística viram uma linha "Outras"
+HEATMAP_MAX_CELLS = 2000
+
+
+def column_figure(base, title, x='DENOM_CIA', y='DENOM_CIA', barmode=None):
+  fig = px.bar(
+    base,
+    x=x,
+    y=y,
+    title=title,
+    barmode=barmode
+  )
+  fig.update_xaxes(dtick=1, title_text='')
+  fig.update_yaxes(title_text='')
+  return fig
+
+
+def line_figure(base, title, x='DT_FIM_EXERC', y='LUCRO LIQUIDO', color='DENOM_CIA'):
+  fig = px.line(
+    base,
+    x=x,
+    y=y,
+    color=color,
+    title=title,
+  )
+  fig.update_xaxes(dtick=1, title_text='')
+  fig.update_yaxes(title_text='')
+  return fig
+
+
+def heatmap_figure(base, title):
+  fig = px.imshow(
+    base,
+    labels={'color': 'valor', 'DENOM_CIA': 'Empresa'},
+    x=base.columns.get_level_values(1),
+    y=base.index,
+    title=title,
+  )
+  fig.update_xaxes(dtick=1, title_text='')
+  fig.update_yaxes(title_text='')
+  return fig
+
+
+def rank_figure(base, title, x='DT_FIM_EXERC', color='DENOM_CIA'):
+  # base vem de rankings.peer_frame: percentil no segmento e ano, com z-score e quartil no hover
+  fig = px.line(
+    base,
+    x=x,
+    y='PERCENTIL',
+    color=color,
+    hover_data={'ZSCORE': ':.2f', 'QUARTIL': ':.0f'},
+    title=title,
+    markers=True,
+  )
+  fig.update_xaxes(dtick=1, title_text='')
+  fig.update_yaxes(title_text='percentil no segmento', range=[0, 105])
+  return fig
+
+
+def rank_companies(matrix, statistic):
+  if statistic == 'abs': return matrix.abs().mean(axis=1)
+  return getattr(matrix, statistic)(axis=1)
+
+
+def cluster_order(matrix):
+  # Linhas sem valor num ano recebem a média do ano para entrar na distância
+  filled = matrix.fillna(matrix.mean()).fillna(0).to_numpy()
+  return leaves_list(linkage(filled, method='average'))
+
+
+def heatmap_matrix(data, column, max_cells=HEATMAP_MAX_CELLS, rank_by='mean', cluster=False, company='DENOM_CIA', year='DT_FIM_EXERC'):
+  # Matriz empresa x ano do mapa de calor dentro de um orçamento de células. Empresa-ano
+  # repetido vira média; devolve também quantas células e empresas ficaram de fora
+  matrix = data.pivot_table(index=company, columns=year, values=[column], aggfunc='mean', observed=True, dropna=False)
+  total_cells = matrix.size
+  companies = len(matrix)
+  # Recorte sem linhas (ex.: empresa sem dados nos anos escolhidos): nada a orçar
+  if matrix.shape[0] == 0 or matrix.shape[1] == 0: return matrix, 0, 0
+
+  # Orçamento menor que duas linhas: junta anos vizinhos em faixas
+  years = matrix.shape[1]
+  max_years = max(max_cells // 2, 1)
+  if years > max_years:
+    step = math.ceil(years / max_years)
+    labels = matrix.columns.get_level_values(1)
+    matrix = matrix.T.groupby(np.arange(years) // step).mean().T
+    matrix.columns = pd.MultiIndex.from_arrays([[column] * matrix.shape[1], [f'{labels[i]}-{labels[min(i + step, years) - 1]}' for i in range(0, years, step)]])
+
+  rows = max(max_cells // matrix.shape[1], 2)
+  others = None
+  if len(matrix) > rows:
+    score = rank_companies(matrix, rank_by).to_numpy()
+    order = np.argsort(-np.nan_to_num(score, nan=-np.inf), kind='stable')
+    rest = matrix.iloc[np.sort(order[rows - 1:])]
+    others = pd.DataFrame([rest.mean().to_numpy()], index=[f'Outras ({len(rest)})'], columns=matrix.columns)
+    matrix = matrix.iloc[np.sort(order[:rows - 1])]
+
+  if cluster and CLUSTERING and len(matrix) > 2:
+    matrix = matrix.iloc[cluster_order(matrix)]
+  if others is not None:
+    matrix = pd.concat([matrix.set_axis(matrix.index.astype(str)), others])
+    matrix.index.name = company
+
+  omitted = total_cells - matrix.size
+  bucketed = companies - len(matrix) + 1 if others is not None else 0
+  return matrix, omitted, bucketed
+
+
+def heatmap_title(title, omitted, bucketed):
+  if not omitted: return title
+  if not bucketed: return f'{title} ({omitted} células agregadas em faixas de anos)'
+  return f'{title} ({bucketed} empresas em "Outras", {omitted} células omitidas)'
+
+
+def histogram_figure(base, title, x='DENOM_CIA', y='DENOM_CIA', barmode=None):
+  fig = px.histogram(
+    base,
+    x=x,
+    y=y,
+    title=title,
+    barmode=barmode,
+    labels=['DENOM_CIA']
+  )
+  fig.update_xaxes(dtick=1, title_text='')
+  fig.update_yaxes(title_text='')
+  return fig
+
+
+def company_groups(data, companies):
+  indices = data.groupby('DENOM_CIA', observed=True).indices
+  return [(company, data.iloc[indices[company]]) for company in companies]
+
+
+def liquidity_grid_figure(groups, factor):
+  companies = [company for company, _ in groups]
+  get_rows = lambda : math.ceil(len(companies)/2) if len(companies) > 1 else 1
+  fig = make_subplots(
+    rows=get_rows(),
+    cols=2,
+    shared_xaxes=True,
+    subplot_titles=companies,
+    vertical_spacing=(1/(get_rows() - 1)) * 0.4 if get_rows() > 1 else 0.4
+  )
+  # Um único add_traces: adicionar trace a trace revalida a figura inteira a cada chamada
+  traces, rows, cols = [], [], []
+  for i, (company, base) in enumerate(groups, start=1):
+    traces.append(go.Bar(
+      x=base['DT_FIM_EXERC'],
+      y=base['CAPITAL CIRCULANTE LIQUIDO'],
+      name='Capital Circulante',
+      marker_color='blue',
+    ))
+    traces.append(go.Scattergl(
+      x=base['DT_FIM_EXERC'],
+      y=base['LIQUIDEZ CORRENTE'] * factor,
+      mode='lines',
+      name='LIQUIDEZ CORRENTE',
+      line=dict(color='red', width=2),
+    ))
+    rows.extend([math.ceil(i/2)] * 2)
+    cols.extend([1 if i % 2 != 0 else 2] * 2)
+  if traces: fig.add_traces(traces, rows=rows, cols=cols)
+  fig.update_layout(showlegend=False)
+  return fig
+
+
+def liability_pies_figure(totals):
+  titles = [' '.join(company.split(' ')[:2]) for company in totals.index]
+  fig = make_subplots(rows=1, cols=len(titles), subplot_titles=titles, specs=[[{'type': 'pie'}] * len(titles)])
+  traces = [
+    go.Pie(
+      labels=['EXIGIVEL A LONGO PRAZO', 'PASSIVO CIRCULANTE'],
+      values=[row['EXIGIVEL A LONGO PRAZO'], row['PASSIVO CIRCULANTE']],
+    )
+    for _, row in totals.iterrows()
+  ]
+  if traces: fig.add_traces(traces, rows=[1] * len(traces), cols=list(range(1, len(traces) + 1)))
+  fig.update_layout(showlegend=False)
+  return fig
+
+
+def gaps_table_figure(table, title):
+  fig = go.Figure(
+    data=[go.Table(header=dict(values=['Empresa', 'Período'], fill_color='rgb(0, 104, 201)', line_color='darkslategray'),
+    cells=dict(values=[list(table['DENOM_CIA']), list(table['PERIODO'])], fill_color='rgb(120, 120, 120)'))
+  ])
+  fig.update_layout(title=title)
+  return fig
+
+
+def figure_size(fig):
+  return len(pio.to_json(fig, validate=False))
+
+
+class FigureCache:
+  # As figuras são compartilhadas entre sessões; quem usa não pode alterá-las depois do get
+  def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.entries = OrderedDict()
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  def get(self, key, build):
+    with self.lock:
+      if key in self.entries:
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.entries[key][0]
+      self.misses += 1
+
+    fig = build()
+    size = figure_size(fig)
+    if size > self.max_bytes: return fig
+
+    with self.lock:
+      if key in self.entries: return self.entries[key][0]
+      self.entries[key] = (fig, size)
+      self.bytes += size
+      while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+        _, (_, evicted) = self.entries.popitem(last=False)
+        self.bytes -= evicted
+    return fig
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.bytes = 0
+
+  def stats(self):
+    with self.lock:
+      return {
+        'entries': len(self.entries),
+        'bytes': self.bytes,
+        'hits': self.hits,
+        'misses': self.misses,
+      }
@@ -0,0 +1,296 @@
+import copy
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# sum/mean/min/max saem das tabelas pré-computadas; o resto recalcula (com cache) sobre as linhas
+WINDOW_FUNCTIONS = ('sum', 'mean', 'min', 'max')
+
+# Funções de agregação oferecidas no dashboard e na API, pelo nome mostrado
+AGG_MAP = {
+  'Soma': 'sum', 'Média': 'mean', 'Mínimo': 'min', 'Máximo': 'max', 'Mediana' :'median', 'Desvio padrão': 'std'
+}
+
+
+def prefix(grid):
+  zeros = np.zeros((grid.shape[0], 1), dtype=grid.dtype)
+  return np.concatenate([zeros, np.cumsum(grid, axis=1)], axis=1)
+
+
+def sparse_table(grid, reduce):
+  levels = [grid]
+  width = 1
+  while width * 2 <= grid.shape[1]:
+    last = levels[-1]
+    levels.append(reduce(last[:, :-width], last[:, width:]))
+    width *= 2
+  return levels
+
+
+def sparse_query(levels, reduce, start, end):
+  level = (end - start + 1).bit_length() - 1
+  table = levels[level]
+  return reduce(table[:, start], table[:, end - (1 << level) + 1])
+
+
+class AggregationCube:
+  def __init__(self, data, metrics, company='DENOM_CIA', category='TIPO', year='DT_FIM_EXERC', cache_size=256, version=0):
+    self.metrics = list(metrics)
+    self.company = company
+    self.category = category
+    self.year = year
+    self.cache_size = cache_size
+    # Quantos deltas do storage já estão nas grades (ver sync)
+    self.version = version
+    self.lock = threading.RLock()
+    self.build(data)
+
+  def build(self, data):
+    self.data = data
+    keys = data[[self.category, self.company]]
+    entity_of_row = keys.groupby([self.category, self.company], observed=True, sort=True).ngroup().to_numpy()
+    entities = keys.drop_duplicates().sort_values([self.category, self.company])
+    self.entity_category = entities[self.category].astype(str).to_numpy()
+    self.entity_company = entities[self.company].astype(str).to_numpy()
+    self.entity_index = {key: i for i, key in enumerate(zip(self.entity_category, self.entity_company))}
+
+    years = data[self.year].to_numpy().astype(np.int64)
+    self.first_year = int(years.min())
+    self.last_year = int(years.max())
+    shape = (len(entities), self.last_year - self.first_year + 1)
+
+    # Grades por entidade x ano antes dos prefixos/sparse tables; um delta só soma nelas
+    self.dtypes = {metric: data[metric].dtype for metric in self.metrics}
+    self.grid_rows = np.zeros(shape, dtype=np.int64)
+    self.grid_counts, self.grid_sums, self.grid_mins, self.grid_maxs = {}, {}, {}, {}
+    for metric in self.metrics:
+      self.grid_counts[metric] = np.zeros(shape, dtype=np.int64)
+      # Colunas inteiras somam em int64 para o resultado bater exatamente com o groupby
+      self.grid_sums[metric] = np.zeros(shape, dtype=np.int64 if pd.api.types.is_integer_dtype(self.dtypes[metric]) else np.float64)
+      self.grid_mins[metric] = np.full(shape, np.nan)
+      self.grid_maxs[metric] = np.full(shape, np.nan)
+    self.accumulate(data, entity_of_row, years - self.first_year)
+    self.index()
+    self.cache = OrderedDict()
+
+  def accumulate(self, data, entity_of_row, offsets):
+    cells = (entity_of_row, offsets)
+    np.add.at(self.grid_rows, cells, 1)
+    for metric in self.metrics:
+      column = data[metric]
+      values = column.to_numpy(dtype=np.float64)
+      valid = ~np.isnan(values)
+      np.add.at(self.grid_counts[metric], cells, valid)
+      if pd.api.types.is_integer_dtype(column.dtype):
+        np.add.at(self.grid_sums[metric], cells, column.to_numpy())
+      else:
+        np.add.at(self.grid_sums[metric], cells, np.where(valid, values, 0))
+      np.fmin.at(self.grid_mins[metric], cells, values)
+      np.fmax.at(self.grid_maxs[metric], cells, values)
+
+  def index(self):
+    self.single_category = len(set(self.entity_company)) == len(self.entity_company)
+    self.rows = prefix(self.grid_rows)
+    self.counts = {metric: prefix(grid) for metric, grid in self.grid_counts.items()}
+    self.sums = {metric: prefix(grid) for metric, grid in self.grid_sums.items()}
+    self.mins = {metric: sparse_table(grid, np.fmin) for metric, grid in self.grid_mins.items()}
+    self.maxs = {metric: sparse_table(grid, np.fmax) for metric, grid in self.grid_maxs.items()}
+
+  def grow(self, entities, before, after):
+    pad = lambda grid, fill : np.pad(grid, ((0, entities), (before, after)), constant_values=fill)
+    self.grid_rows = pad(self.grid_rows, 0)
+    for metric in self.metrics:
+      self.grid_counts[metric] = pad(self.grid_counts[metric], 0)
+      self.grid_sums[metric] = pad(self.grid_sums[metric], 0)
+      self.grid_mins[metric] = pad(self.grid_mins[metric], np.nan)
+      self.grid_maxs[metric] = pad(self.grid_maxs[metric], np.nan)
+
+  def update(self, data, rows):
+    # data já inclui rows. Só as células do delta são somadas; prefixos e sparse tables são
+    # refeitos sobre as grades (entidades x anos), sem voltar às linhas antigas
+    with self.lock:
+      if any(data[metric].dtype != dtype for metric, dtype in self.dtypes.items()):
+        # Um delta com lacuna numa coluna inteira muda o dtype; aí não tem como aproveitar
+        self.build(data)
+        return
+
+      keys = zip(rows[self.category].astype(str), rows[self.company].astype(str))
+      new = [key for key in dict.fromkeys(keys) if key not in self.entity_index]
+      for key in new: self.entity_index[key] = len(self.entity_index)
+      if new:
+        self.entity_category = np.concatenate([self.entity_category, np.array([key[0] for key in new], dtype=object)])
+        self.entity_company = np.concatenate([self.entity_company, np.array([key[1] for key in new], dtype=object)])
+
+      years = rows[self.year].to_numpy().astype(np.int64)
+      before = max(self.first_year - int(years.min()), 0)
+      after = max(int(years.max()) - self.last_year, 0)
+      self.grow(len(new), before, after)
+      self.first_year -= before
+      self.last_year += after
+
+      entity_of_row = np.array([self.entity_index[key] for key in zip(rows[self.category].astype(str), rows[self.company].astype(str))], dtype=np.int64)
+      self.accumulate(rows, entity_of_row, years - self.first_year)
+      self.index()
+      self.data = data
+      self.invalidate(set(rows[self.category].astype(str)), int(years.min()), int(years.max()))
+
+  def copy(self):
+    # Cubo independente para receber deltas sem mexer neste, que pode continuar servindo: as grades
+    # (somadas no lugar pelo accumulate) são copiadas; prefixos e sparse tables são sempre refeitos
+    # pelo index, então ficam compartilhados até lá
+    with self.lock:
+      other = copy.copy(self)
+      other.lock = threading.RLock()
+      other.entity_index = dict(self.entity_index)
+      other.grid_rows = self.grid_rows.copy()
+      other.grid_counts, other.grid_sums, other.grid_mins, other.grid_maxs = (
+        {metric: grid.copy() for metric, grid in grids.items()}
+        for grids in (self.grid_counts, self.grid_sums, self.grid_mins, self.grid_maxs)
+      )
+      other.cache = OrderedDict(self.cache)
+      return other
+
+  def sync(self, data, version, load):
+    # load(inicio) devolve as linhas dos deltas a partir de inicio; várias sessões podem chamar juntas
+    with self.lock:
+      if self.version >= version: return
+      rows = load(self.version)
+      if rows is not None: self.update(data, rows)
+      self.version = version
+
+  def invalidate(self, categories, min_year, max_year):
+    # Descarta só os resultados exatos cujo recorte cruza o delta
+    with self.lock:
+      for key in list(self.cache):
+        _, _, start, end, category, _ = key
+        if (category is None or category in categories) and start <= max_year and end >= min_year:
+          del self.cache[key]
+
+  def clear_cache(self):
+    with self.lock:
+      self.cache.clear()
+
+  def exact(self, *key):
+    with self.lock:
+      if key in self.cache:
+        self.cache.move_to_end(key)
+        return self.cache[key]
+      result = self.exact_aggregate(*key)
+      self.cache[key] = result
+      while len(self.cache) > self.cache_size: self.cache.popitem(last=False)
+      return result
+
+  def window(self, min_year, max_year):
+    start = max(int(min_year), self.first_year) - self.first_year
+    end = min(int(max_year), self.last_year) - self.first_year
+    return start, end
+
+  def select(self, start, end, category=None, companies=None):
+    mask = (self.rows[:, end + 1] - self.rows[:, start]) > 0
+    if category is not None: mask &= self.entity_category == category
+    if companies: mask &= np.isin(self.entity_company, list(companies))
+    return np.flatnonzero(mask)
+
+  def window_values(self, metric, func, entities, start, end):
+    if func == 'min':
+      return sparse_query(self.mins[metric], np.fmin, start, end)[entities]
+    if func == 'max':
+      return sparse_query(self.maxs[metric], np.fmax, start, end)[entities]
+
+    total = self.sums[metric][entities, end + 1] - self.sums[metric][entities, start]
+    if func == 'sum': return total
+    count = self.counts[metric][entities, end + 1] - self.counts[metric][entities, start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+      return np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+  def aggregate(self, columns, func, min_year, max_year, category=None, companies=None):
+    # O lock só importa enquanto um update troca as tabelas; consultas custam microssegundos
+    with self.lock:
+      columns = list(columns)
+      companies = tuple(sorted(companies)) if companies else None
+      if func not in WINDOW_FUNCTIONS or not self.single_category:
+        # Empresas em mais de um segmento precisam somar entidades; deixa para o caminho exato
+        return self.exact(tuple(columns), func, int(min_year), int(max_year), category, companies).copy()
+
+      start, end = self.window(min_year, max_year)
+      if start > end:
+        # Intervalo fora dos anos do cubo (ou invertido): nenhuma empresa. A janela vira o
+        # primeiro ano só para as tabelas darem colunas vazias com os mesmos dtypes
+        entities, start, end = np.array([], dtype=np.int64), 0, 0
+      else:
+        entities = self.select(start, end, category, companies)
+      names = self.entity_company[entities]
+      order = np.argsort(names, kind='stable')
+      entities, names = entities[order], names[order]
+
+      result = pd.DataFrame({self.company: pd.Categorical(names, categories=names)})
+      for column in columns:
+        values = self.window_values(column, func, entities, start, end)
+        if func != 'mean' and pd.api.types.is_integer_dtype(self.dtypes[column]):
+          values = values.astype(self.dtypes[column])
+        result[column] = values
+      return result
+
+  def exact_aggregate(self, columns, func, min_year, max_year, category=None, companies=None):
+    data = self.data
+    mask = (data[self.year] >= min_year) & (data[self.year] <= max_year)
+    if category is not None: mask &= data[self.category] == category
+    if companies: mask &= data[self.company].isin(companies)
+    base = data[mask]
+    base = base.assign(**{self.company: base[self.company].cat.remove_unused_categories()})
+    return base.groupby(self.company, observed=True).agg({column: func for column in columns}).reset_index()
+
+
+if __name__ == '__main__':
+  import itertools
+
+  import schema
+  import storage
+
+  data = storage.load_data()
+  metrics = schema.indicator_columns()
+  cube = AggregationCube(data, metrics)
+  years = range(cube.first_year, cube.last_year + 1)
+  # Além das janelas dentro da base: antes do primeiro ano, depois do último, invertida e cobrindo tudo
+  outside = [
+    (cube.first_year - 5, cube.first_year - 1),
+    (cube.last_year + 1, cube.last_year + 10),
+    (cube.last_year + 8, cube.last_year + 3),
+    (cube.last_year, cube.first_year),
+    (cube.first_year - 3, cube.last_year + 3),
+  ]
+  worst = 0.0
+  checked = 0
+  for category in data['TIPO'].unique():
+    for min_year, max_year in [*itertools.combinations_with_replacement(years, 2), *outside]:
+      base = data[(data['TIPO'] == category) & (data['DT_FIM_EXERC'] >= min_year) & (data['DT_FIM_EXERC'] <= max_year)]
+      base = schema.remove_unused_categories(base)
+      for func in ('sum', 'mean', 'min', 'max', 'median', 'std'):
+        expected = base.groupby('DENOM_CIA', observed=True).agg({metric: func for metric in metrics}).reset_index()
+        result = cube.aggregate(metrics, func, min_year, max_year, category=category)
+        pd.testing.assert_frame_equal(result, expected, check_exact=False, rtol=1e-12, check_categorical=False)
+        for metric in metrics:
+          if pd.api.types.is_integer_dtype(expected[metric].dtype) or func in ('min', 'max', 'median', 'std'):
+            assert result[metric].equals(expected[metric]), (category, min_year, max_year, func, metric)
+          else:
+            deviation = ((result[metric] - expected[metric]).abs() / expected[metric].abs().clip(lower=1)).max()
+            worst = max(worst, 0 if pd.isna(deviation) else deviation)
+        checked += 1
+  print(f'{checked} consultas conferidas com o groupby; maior desvio relativo em somas/médias de float: {worst:.2e}')
+
+  # Cubo montado sem o último ano e atualizado com ele tem que ficar igual ao montado de uma vez
+  last = data['DT_FIM_EXERC'] == cube.last_year
+  # (numa cópia: o cubo de antes do delta continua com os números de antes)
+  partial = AggregationCube(schema.remove_unused_categories(data[~last]), metrics)
+  before = {category: partial.aggregate(metrics, 'sum', cube.first_year, cube.last_year, category=category) for category in data['TIPO'].unique()}
+  updated = partial.copy()
+  updated.update(data, data[last])
+  for category in data['TIPO'].unique():
+    pd.testing.assert_frame_equal(partial.aggregate(metrics, 'sum', cube.first_year, cube.last_year, category=category), before[category])
+    for func in ('sum', 'mean', 'min', 'max'):
+      expected = cube.aggregate(metrics, func, cube.first_year, cube.last_year, category=category)
+      result = updated.aggregate(metrics, func, cube.first_year, cube.last_year, category=category)
+      pd.testing.assert_frame_equal(result, expected, check_categorical=False)
+  print(f'cubo incremental ({int(last.sum())} linhas de {cube.last_year}) confere com o cubo completo')
@@ -0,0 +1,201 @@
+import argparse
+import glob
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import schema
+import storage
+
+# Arquivos anuais da CVM (dados.cvm.gov.br/dataset/cia_aberta-doc-dfp), ex.: dfp_cia_aberta_BPA_con_2022.csv
+FILE_PATTERN = re.compile(r'dfp_cia_aberta_(BPA|BPP|DRE|DFC_MD|DFC_MI)_(con|ind)_(\d{4})\.csv$', re.IGNORECASE)
+READ_COLUMNS = ['CD_CVM', 'DENOM_CIA', 'DT_REFER', 'VERSAO', 'ORDEM_EXERC', 'ESCALA_MOEDA', 'CD_CONTA', 'DS_CONTA', 'VL_CONTA']
+
+# Contas do plano padrão da CVM usadas nos indicadores (empresas não financeiras)
+ACCOUNTS = {
+  '1.01': 'ATIVO CIRCULANTE',
+  '1.01.03': 'CONTAS A RECEBER',
+  '1.01.04': 'ESTOQUES',
+  '1.02.02': 'INVESTIMENTOS',
+  '2.01': 'PASSIVO CIRCULANTE',
+  '2.01.02': 'FORNECEDORES',
+  '2.02': 'PASSIVO NAO CIRCULANTE',
+  '2.03': 'PATRIMONIO LIQUIDO',
+  '3.01': 'RECEITA',
+  '3.02': 'CUSTO',
+  '3.04': 'DESPESAS OPERACIONAIS',
+  '3.05': 'EBIT',
+  '3.06.02': 'DESPESAS FINANCEIRAS',
+  '3.11': 'LUCRO LIQUIDO',
+  '6.01': 'CAIXA OPERACIONAL',
+}
+# Dividendos e JCP pagos não têm código fixo; são as linhas do fluxo de financiamento com esse nome
+DIVIDENDS_PREFIX = '6.03.'
+DIVIDENDS_PATTERN = r'dividendo|juros sobre (?:o )?capital'
+
+
+def reduce_file(path, chunksize=200_000):
+  # Lê o arquivo em blocos e guarda só as linhas das contas usadas; a memória fica limitada
+  # ao tamanho do bloco mais as contas já filtradas, não ao tamanho do arquivo
+  scope = FILE_PATTERN.search(os.path.basename(path)).group(2).lower()
+  parts = []
+  # Colunas de texto repetitivas como category: filtros e .str rodam uma vez por valor distinto
+  chunks = pd.read_csv(
+    path, sep=';', encoding='latin-1', usecols=READ_COLUMNS, chunksize=chunksize,
+    dtype={column: 'category' for column in ('CD_CONTA', 'DS_CONTA', 'DENOM_CIA', 'DT_REFER', 'ORDEM_EXERC', 'ESCALA_MOEDA')},
+  )
+  for chunk in chunks:
+    fixed = chunk['CD_CONTA'].isin(ACCOUNTS.keys())
+    dividends = chunk['CD_CONTA'].str.startswith(DIVIDENDS_PREFIX) & chunk['DS_CONTA'].str.contains(DIVIDENDS_PATTERN, case=False, regex=True, na=False)
+    chunk = chunk[fixed | dividends]
+    if chunk.empty: continue
+
+    # Tudo em milhares de reais, como no database.csv
+    scale = np.where((chunk['ESCALA_MOEDA'].str.upper() == 'UNIDADE').to_numpy(dtype=bool), 1 / 1000, 1)
+    parts.append(pd.DataFrame({
+      'CD_CVM': chunk['CD_CVM'].to_numpy(),
+      'DENOM_CIA': chunk['DENOM_CIA'].to_numpy(),
+      'DT_FIM_EXERC': chunk['DT_REFER'].str[:4].astype(np.int16).to_numpy(),
+      'VERSAO': chunk['VERSAO'].to_numpy(),
+      'ANTERIOR': chunk['ORDEM_EXERC'].str.upper().str.startswith('PEN').to_numpy(),
+      'CONTA': chunk['CD_CONTA'].map(ACCOUNTS).where(fixed[fixed | dividends], 'DIVIDENDOS').to_numpy(),
+      'VALOR': chunk['VL_CONTA'].to_numpy(dtype=np.float64) * scale,
+    }))
+
+  if not parts: return pd.DataFrame(columns=['CD_CVM', 'DENOM_CIA', 'DT_FIM_EXERC', 'VERSAO', 'ANTERIOR', 'CONTA', 'VALOR', 'ESCOPO'])
+  # Volta ao processo principal em formato compacto
+  reduced = pd.concat(parts, ignore_index=True).assign(ESCOPO=scope)
+  return reduced.astype({column: 'category' for column in ('DENOM_CIA', 'CONTA', 'ESCOPO')})
+
+
+def statement_files(paths):
+  files = []
+  for path in paths:
+    candidates = glob.glob(os.path.join(path, '**', '*.csv'), recursive=True) if os.path.isdir(path) else [path]
+    files.extend(sorted(file for file in candidates if FILE_PATTERN.search(os.path.basename(file))))
+  return files
+
+
+def read_statements(files, workers=None, chunksize=200_000):
+  # Um arquivo por tarefa; cada processo devolve só as linhas reduzidas
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    frames = list(pool.map(reduce_file, files, [chunksize] * len(files)))
+  statements = pd.concat(frames, ignore_index=True)
+
+  # Reapresentações: vale a última versão de cada entrega
+  latest = statements.groupby(['CD_CVM', 'DT_FIM_EXERC', 'ESCOPO'], observed=True)['VERSAO'].transform('max')
+  statements = statements[statements['VERSAO'] == latest]
+
+  # Consolidado quando a empresa publica; individual só para quem não tem consolidado no ano
+  keys = pd.MultiIndex.from_frame(statements[['CD_CVM', 'DT_FIM_EXERC']])
+  consolidated = keys[(statements['ESCOPO'] == 'con').to_numpy()]
+  return statements[(statements['ESCOPO'] == 'con').to_numpy() | ~keys.isin(consolidated)]
+
+
+def pivot_accounts(statements):
+  accounts = statements.pivot_table(index=['CD_CVM', 'DT_FIM_EXERC'], columns=['CONTA', 'ANTERIOR'], values='VALOR', aggfunc='sum', observed=True)
+  names = statements.sort_values('DT_FIM_EXERC', kind='stable').groupby('CD_CVM')['DENOM_CIA'].last().astype(str)
+  return accounts, names
+
+
+def indicators(accounts):
+  # Contas ausentes valem zero; média usa o saldo do exercício anterior quando ele veio no arquivo
+  rows = len(accounts)
+  get = lambda name, previous=False : accounts[(name, previous)].to_numpy(dtype=np.float64) if (name, previous) in accounts.columns else np.full(rows, np.nan)
+  value = lambda name : np.nan_to_num(get(name))
+  average = lambda name : np.where(np.isnan(get(name, True)), value(name), (value(name) + np.nan_to_num(get(name, True))) / 2)
+
+  ac, pc, elp, pl = value('ATIVO CIRCULANTE'), value('PASSIVO CIRCULANTE'), value('PASSIVO NAO CIRCULANTE'), value('PATRIMONIO LIQUIDO')
+  revenue, cost, ebit, net = value('RECEITA'), value('CUSTO'), value('EBIT'), value('LUCRO LIQUIDO')
+  financial = value('DESPESAS FINANCEIRAS')
+  liabilities = pc + elp
+  total = liabilities + pl
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    columns = {
+      'RECEITA LIQUIDA': revenue,
+      'ATIVO CIRCULANTE': ac,
+      'PASSIVO CIRCULANTE': pc,
+      'CAPITAL CIRCULANTE LIQUIDO': ac - pc,
+      'LIQUIDEZ CORRENTE': ac / pc,
+      'LIQUIDEZ A SECO': (ac - average('ESTOQUES')) / pc,
+      'EXIGIVEL A LONGO PRAZO': elp,
+      'EXIGIVEL / ATIVO (TOTAL)': liabilities / total,
+      'ENDIVIDAMENTO GERAL': liabilities / pl,
+      'CAPITAIS DE LONGO PRAZO': elp / pl,
+      'COBERTURA DE JUROS': ebit / financial,
+      'COBERTURA DE JUROS (CAIXA OPERAÇÕES)': value('CAIXA OPERACIONAL') / financial,
+      'CUSTO DA MERCADORIA VENDIDA': cost,
+      'CUSTO DA MERCADORIA VENDIDA %': cost / revenue,
+      'DESPESAS OPERACIONAIS %': value('DESPESAS OPERACIONAIS') / revenue,
+      'GIRO': revenue / total,
+      'ROA': ebit / total,
+      'ROE': net / pl,
+      'ROI': net / value('INVESTIMENTOS'),
+      'MG_OP': ebit / revenue,
+      'MG_LIQ': net / revenue,
+      'JUROS': financial / (liabilities / 2),
+      'PAYOUT': -value('DIVIDENDOS') / net,
+      'GIRO DE VALORES A RECEBER': revenue / average('CONTAS A RECEBER'),
+      'GIRO DE DUPLICATAS A PAGAR': cost / average('FORNECEDORES'),
+      'PATRIMONIO LIQUIDO': pl,
+    }
+  # Divisão por zero vira lacuna, como no database.csv
+  return {column: np.where(np.isinf(values), np.nan, values) for column, values in columns.items()}
+
+
+def build_database(accounts, names, segments):
+  manifest = schema.get_manifest()
+  index = accounts.index.to_frame(index=False)
+  company = index['CD_CVM'].map(names)
+  data = pd.DataFrame({
+    'DENOM_CIA': company,
+    'TIPO': index['CD_CVM'].map(segments.get('CD_CVM', {})).fillna(company.map(segments.get('DENOM_CIA', {}))).fillna('SEM SEGMENTO'),
+    'DT_FIM_EXERC': index['DT_FIM_EXERC'],
+    **indicators(accounts),
+  })
+  for column in schema.columns_of('valor', manifest):
+    if data[column].notna().all(): data[column] = np.round(data[column]).astype(np.int64)
+  return data[list(manifest)].sort_values(['DENOM_CIA', 'DT_FIM_EXERC'], kind='stable').reset_index(drop=True)
+
+
+def known_segments(cadastro=None):
+  # Segmento (TIPO) não vem nos demonstrativos: usa o do database.csv e, se houver, o setor do cadastro da CVM
+  segments = {'DENOM_CIA': storage.load_data().drop_duplicates('DENOM_CIA').set_index('DENOM_CIA')['TIPO'].astype(str).to_dict()}
+  if cadastro:
+    registry = pd.read_csv(cadastro, sep=';', encoding='latin-1', usecols=['CD_CVM', 'SETOR_ATIV']).dropna()
+    segments['CD_CVM'] = registry.drop_duplicates('CD_CVM', keep='last').set_index('CD_CVM')['SETOR_ATIV'].str.upper().to_dict()
+  return segments
+
+
+def run(paths, output, workers=None, chunksize=200_000, cadastro=None, segments=None):
+  files = statement_files(paths)
+  if not files:
+    raise ValueError(f'Nenhum arquivo dfp_cia_aberta_*.csv em {paths}')
+  statements = read_statements(files, workers, chunksize)
+  accounts, names = pivot_accounts(statements)
+  data = build_database(accounts, names, segments if segments is not None else known_segments(cadastro))
+  storage.write_csv(data, output)
+  return data
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Calcula os indicadores do database.csv a partir dos demonstrativos DFP brutos da CVM (BPA/BPP/DRE/DFC)')
+  parser.add_argument('paths', nargs='*', help='arquivos dfp_cia_aberta_*.csv ou pastas com eles')
+  parser.add_argument('--output', default='database_cvm.csv')
+  parser.add_argument('--workers', type=int, default=os.cpu_count())
+  parser.add_argument('--chunksize', type=int, default=200_000, help='linhas lidas por vez de cada arquivo')
+  parser.add_argument('--cadastro', help='cad_cia_aberta.csv da CVM, para o segmento de empresas fora do database.csv')
+  args = parser.parse_args()
+
+  start = time.perf_counter()
+  data = run(args.paths, args.output, args.workers, args.chunksize, args.cadastro)
+  print(f'{args.output}: {len(data)} empresas-ano de {data["DENOM_CIA"].nunique()} empresas em {time.perf_counter() - start:.1f} s')
+
+
+if __name__ == '__main__':
+  main()
@@ -1,9 +1,17 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
 import math
-from plotly.subplots import make_subplots
-import plotly.graph_objects as go
+import os
+from functools import wraps
+import charts
+import cube
+import gaps
+import perf
+import planner
+import rankings
+import schema
+import similarity
+import storage
 
 st.set_page_config(
   layout = 'wide',
@@ -12,121 +20,143 @@ st.set_page_config(
   page_icon='https://icons.iconarchive.com/icons/custom-icon-design/flatastic-9/512/Line-chart-icon.png',
 )
 
-@st.cache_data
-def get_data():
-  data = pd.read_csv('./database.csv').sort_values(by='DT_FIM_EXERC')
-  data['LIQUIDEZ CORRENTE'] = pd.to_numeric(data['LIQUIDEZ CORRENTE'].str.replace(',', '.'))
-  data['LIQUIDEZ A SECO'] = pd.to_numeric(data['LIQUIDEZ A SECO'].str.replace(',', '.'))
-  data['EXIGIVEL / ATIVO (TOTAL)'] = pd.to_numeric(data['EXIGIVEL / ATIVO (TOTAL)'].str.replace(',', '.'))
-  data['ENDIVIDAMENTO GERAL'] = pd.to_numeric(data['ENDIVIDAMENTO GERAL'].str.replace(',', '.'))
-  data['CAPITAIS DE LONGO PRAZO'] = pd.to_numeric(data['CAPITAIS DE LONGO PRAZO'].str.replace(',', '.'))
-  data['COBERTURA DE JUROS'] = pd.to_numeric(data['COBERTURA DE JUROS'].str.replace(',', '.'))
-  data['COBERTURA DE JUROS (CAIXA OPERAÇÕES)'] = pd.to_numeric(data['COBERTURA DE JUROS (CAIXA OPERAÇÕES)'].str.replace(',', '.'))
-  data['MG_LIQ'] = pd.to_numeric(data['MG_LIQ'].str.replace(',', '.'))
-  data['MG_OP'] = pd.to_numeric(data['MG_OP'].str.replace(',', '.'))
-  data['CUSTO DA MERCADORIA VENDIDA %'] = pd.to_numeric(data['CUSTO DA MERCADORIA VENDIDA %'].str.replace(',', '.'))
-  data['DESPESAS OPERACIONAIS %'] = pd.to_numeric(data['DESPESAS OPERACIONAIS %'].str.replace(',', '.'))
-  data['GIRO'] = pd.to_numeric(data['GIRO'].str.replace(',', '.'))
-  data['JUROS'] = pd.to_numeric(data['JUROS'].str.replace(',', '.'))
-  data['ROA'] = pd.to_numeric(data['ROA'].str.replace(',', '.'))
-  data['ROE'] = pd.to_numeric(data['ROE'].str.replace(',', '.'))
-  data['ROI'] = pd.to_numeric(data['ROI'].str.replace(',', '.'))
-  data['GIRO DE VALORES A RECEBER'] = pd.to_numeric(data['GIRO DE VALORES A RECEBER'].str.replace(',', '.'))
-  data['GIRO DE DUPLICATAS A PAGAR'] = pd.to_numeric(data['GIRO DE DUPLICATAS A PAGAR'].str.replace(',', '.'))
-  return data
+# Medições do rerun atual; só liga quando o painel Desempenho está marcado
+timings = st.session_state['perf-timings'] = perf.Timings(enabled=st.session_state.get('perf-enabled', False))
+PERF_LOG = os.environ.get('BOVESPA_PERF_LOG', './desempenho.jsonl')
+
+# Manifesto do store: muda quando o CSV é regerado ou quando um delta é ingerido (python storage.py --delta)
+state = storage.dataset_state()
+
+# Um DataFrame só leitura sobre colunas mapeadas em memória, o mesmo objeto para todas as
+# sessões (st.cache_data entregaria uma cópia desserializada a cada rerun)
+@st.cache_resource(max_entries=2)
+def get_data(version):
+  perf.note(cache='miss')
+  return storage.load_shared(float32=os.environ.get('BOVESPA_FLOAT32') == '1')
+
+@st.cache_resource(max_entries=2)
+def get_cube(_data, base_version, _applied):
+  perf.note(cube='miss')
+  return cube.AggregationCube(_data, schema.indicator_columns(), version=_applied)
+
+def get_synced_cube():
+  # O cubo é refeito só se o CSV base mudar; deltas novos entram por cube.update
+  aggregation = get_cube(full_data, state['sha256'], len(state['deltas']))
+  aggregation.sync(full_data, len(state['deltas']), lambda start : storage.load_deltas(start))
+  return aggregation
+
+# Percentil, z-score e quartil por segmento e ano de todos os indicadores, calculados uma vez
+# por CSV base sobre o full_data; cada delta só recalcula os grupos que toca e os filtros só
+# recortam as linhas
+@st.cache_resource(max_entries=2)
+def get_rankings(base_version, _data, _applied):
+  perf.note(cache='miss')
+  return rankings.PeerRankings(_data, schema.indicator_columns(), version=_applied)
+
+def get_synced_rankings():
+  ranks = get_rankings(state['sha256'], full_data, len(state['deltas']))
+  return ranks.sync(full_data, len(state['deltas']), lambda start : storage.load_deltas(start))
+
+# Índice de semelhança entre empresas (vetores indicador x ano normalizados), um por CSV base;
+# deltas novos entram por SimilarityIndex.update
+@st.cache_resource(max_entries=2)
+def get_similarity(base_version, _data, _applied):
+  perf.note(cache='miss')
+  return similarity.SimilarityIndex(_data, schema.indicator_columns(), version=_applied)
+
+def get_synced_similarity():
+  index = get_similarity(state['sha256'], full_data, len(state['deltas']))
+  index.sync(full_data, len(state['deltas']), lambda start : storage.load_deltas(start))
+  return index
+
+# Uma tabela por recorte e conjunto de colunas; limitada como o FigureCache e o cache do cubo
+@st.cache_data(max_entries=256)
+def get_gaps(_data, filter_key, columns):
+  perf.note(cache='miss')
+  return gaps.find_gaps(_data, columns)
+
+@st.cache_resource
+def get_figure_cache():
+  return charts.FigureCache()
+
+@st.cache_resource
+def get_planner():
+  return planner.ComparativePlanner()
 
 get_metrics = lambda : ['LIQUIDEZ', 'ENDIVIDAMENTO', 'COBERTURA', 'LUCRATIVIDADE', 'ESTRUTURAIS', 'RETORNO', 'ATIVIDADE', 'INSIGHTS']
-data = get_data()
+with perf.stage('get_data', cache='hit'):
+  full_data = get_data(storage.dataset_version(state))
 
 visualization_keys = {
   'heatmap': 'Mapa de Calor',
   'lines': 'Linhas',
-  'column': 'Barras'
+  'column': 'Barras',
+  'rank': 'Posição relativa'
 }
 
 alternative_visualizations = {
   'LIQUIDEZ': {
-    'ATIVO CIRCULANTE': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column']],
-    'PASSIVO CIRCULANTE': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column']],
-    'CAPITAL CIRCULANTE LIQUIDO': [visualization_keys['lines'], visualization_keys['heatmap'], visualization_keys['column']],
-    'LIQUIDEZ CORRENTE': [visualization_keys['lines'], visualization_keys['heatmap'], visualization_keys['column']],
+    'ATIVO CIRCULANTE': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column'], visualization_keys['rank']],
+    'PASSIVO CIRCULANTE': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column'], visualization_keys['rank']],
+    'CAPITAL CIRCULANTE LIQUIDO': [visualization_keys['lines'], visualization_keys['heatmap'], visualization_keys['column'], visualization_keys['rank']],
+    'LIQUIDEZ CORRENTE': [visualization_keys['lines'], visualization_keys['heatmap'], visualization_keys['column'], visualization_keys['rank']],
   },
   'ENDIVIDAMENTO': {
-    'ENDIVIDAMENTO GERAL': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column']],
-    'EXIGIVEL A LONGO PRAZO': [visualization_keys['column'], visualization_keys['lines'], visualization_keys['heatmap']],
-    'PATRIMONIO LIQUIDO': [visualization_keys['column'], visualization_keys['lines'], visualization_keys['heatmap']],
-    'EXIGIVEL / ATIVO (TOTAL)': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column']],
-    'CAPITAIS DE LONGO PRAZO': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column']],
+    'ENDIVIDAMENTO GERAL': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column'], visualization_keys['rank']],
+    'EXIGIVEL A LONGO PRAZO': [visualization_keys['column'], visualization_keys['lines'], visualization_keys['heatmap'], visualization_keys['rank']],
+    'PATRIMONIO LIQUIDO': [visualization_keys['column'], visualization_keys['lines'], visualization_keys['heatmap'], visualization_keys['rank']],
+    'EXIGIVEL / ATIVO (TOTAL)': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column'], visualization_keys['rank']],
+    'CAPITAIS DE LONGO PRAZO': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column'], visualization_keys['rank']],
   },
   'COBERTURA': {
-    'COBERTURA DE JUROS': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column']],
-    'COBERTURA DE JUROS (CAIXA OPERAÇÕES)': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column']],
+    'COBERTURA DE JUROS': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column'], visualization_keys['rank']],
+    'COBERTURA DE JUROS (CAIXA OPERAÇÕES)': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column'], visualization_keys['rank']],
   },
   'LUCRATIVIDADE': {
-    'MG_LIQ':  [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column']],
-    'MG_OP':  [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column']],
-    'RECEITA LIQUIDA':  [visualization_keys['lines'], visualization_keys['column'], visualization_keys['heatmap']],
-    'LIQUIDEZ A SECO':  [visualization_keys['lines'], visualization_keys['column'], visualization_keys['heatmap']],
+    'MG_LIQ':  [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column'], visualization_keys['rank']],
+    'MG_OP':  [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column'], visualization_keys['rank']],
+    'RECEITA LIQUIDA':  [visualization_keys['lines'], visualization_keys['column'], visualization_keys['heatmap'], visualization_keys['rank']],
+    'LIQUIDEZ A SECO':  [visualization_keys['lines'], visualization_keys['column'], visualization_keys['heatmap'], visualization_keys['rank']],
   },
   'ESTRUTURAIS': {
-    'CUSTO DA MERCADORIA VENDIDA':  [visualization_keys['column'], visualization_keys['lines'], visualization_keys['heatmap']],
-    'DESPESAS OPERACIONAIS %':  [visualization_keys['column'], visualization_keys['lines'], visualization_keys['heatmap']],
-    'JUROS':  [visualization_keys['lines'], visualization_keys['heatmap'], visualization_keys['column']],
-    'GIRO':  [visualization_keys['lines'], visualization_keys['heatmap'], visualization_keys['column']],
+    'CUSTO DA MERCADORIA VENDIDA':  [visualization_keys['column'], visualization_keys['lines'], visualization_keys['heatmap'], visualization_keys['rank']],
+    'DESPESAS OPERACIONAIS %':  [visualization_keys['column'], visualization_keys['lines'], visualization_keys['heatmap'], visualization_keys['rank']],
+    'JUROS':  [visualization_keys['lines'], visualization_keys['heatmap'], visualization_keys['column'], visualization_keys['rank']],
+    'GIRO':  [visualization_keys['lines'], visualization_keys['heatmap'], visualization_keys['column'], visualization_keys['rank']],
   },
   'RETORNO': {
-    'ROA': [visualization_keys['lines'], visualization_keys['heatmap'], visualization_keys['column']],
-    'ROE': [visualization_keys['lines'], visualization_keys['heatmap'], visualization_keys['column']],
-    'ROI': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column']],
+    'ROA': [visualization_keys['lines'], visualization_keys['heatmap'], visualization_keys['column'], visualization_keys['rank']],
+    'ROE': [visualization_keys['lines'], visualization_keys['heatmap'], visualization_keys['column'], visualization_keys['rank']],
+    'ROI': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column'], visualization_keys['rank']],
   },
   'ATIVIDADE': {
-    'GIRO': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column']],
-    'GIRO DE VALORES A RECEBER': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column']],
-    'GIRO DE DUPLICATAS A PAGAR': [visualization_keys['lines'], visualization_keys['lines'], visualization_keys['heatmap']],
+    'GIRO': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column'], visualization_keys['rank']],
+    'GIRO DE VALORES A RECEBER': [visualization_keys['heatmap'], visualization_keys['lines'], visualization_keys['column'], visualization_keys['rank']],
+    'GIRO DE DUPLICATAS A PAGAR': [visualization_keys['lines'], visualization_keys['lines'], visualization_keys['heatmap'], visualization_keys['rank']],
   },
 }
 
 runtime_vars = {}
 
-def find_closed_intervals(years):
-  if len(years) == 0:
-    return []
-
-  closed_intervals = []
-  start_year = years[0]
-  end_year = years[0]
-
-  for year in years[1:]:
-    if year == end_year + 1:
-      end_year = year
-    else:
-      if start_year == end_year:
-        closed_intervals.append(str(start_year))
-      else:
-        closed_intervals.append(f"{start_year}-{end_year}")
-      start_year = end_year = year
-
-  if start_year == end_year:
-    closed_intervals.append(str(start_year))
-  else:
-    closed_intervals.append(f"{start_year}-{end_year}")
-
-  return closed_intervals
-
 ## SIDEBAR-----------------------------------------------------------------------------------------------------------------------------------
 st.sidebar.title('Financial Dashboard')
 st.sidebar.header('Filtros')
 selected_metric = st.sidebar.selectbox('Demonstrativos', get_metrics())
+selected_category = None
+# Os filtros trabalham com posições de linha sobre o full_data; só o recorte final é materializado
+rows = slice(None)
 if selected_metric != 'INSIGHTS':
-  selected_category = st.sidebar.selectbox('Segmento', data['TIPO'].unique(), index=2)
-  data = data[data['TIPO'] == selected_category]
-min_year = st.sidebar.number_input('Ano inicial', min_value=data['DT_FIM_EXERC'].min(), max_value=data['DT_FIM_EXERC'].max())
-max_year = st.sidebar.number_input('Ano final', min_value=min_year, max_value=data['DT_FIM_EXERC'].max(), value=data['DT_FIM_EXERC'].max())
+  selected_category = st.sidebar.selectbox('Segmento', full_data['TIPO'].unique(), index=2)
+  with perf.stage('filter segment'):
+    rows = storage.select_rows(full_data, category=selected_category)
+years = full_data['DT_FIM_EXERC'].iloc[rows]
+min_year = st.sidebar.number_input('Ano inicial', min_value=years.min(), max_value=years.max())
+max_year = st.sidebar.number_input('Ano final', min_value=min_year, max_value=years.max(), value=years.max())
 
 if selected_metric != 'INSIGHTS':
-  selected_companies = st.sidebar.multiselect('Empresa', data['DENOM_CIA'].unique(), placeholder="Selecione")
+  selected_companies = st.sidebar.multiselect('Empresa', full_data['DENOM_CIA'].iloc[rows].unique(), placeholder="Selecione")
 else:
-  selected_companies = st.sidebar.multiselect('Especificação', get_data()['TIPO'].unique(), placeholder="Selecione")
+  selected_companies = st.sidebar.multiselect('Especificação', full_data['TIPO'].unique(), placeholder="Selecione")
 
 
 if alternative_visualizations.get(selected_metric):
@@ -134,25 +164,69 @@ if alternative_visualizations.get(selected_metric):
   for key in dict.keys(alternative_visualizations[selected_metric]):
     runtime_vars[f'VISUALIZATION {key}'] = st.sidebar.selectbox(key, alternative_visualizations[selected_metric][key])
 
+# Orçamento dos mapas de calor: acima do limite de células, as empresas fora do top-N viram "Outras"
+heatmap_rank_map = {'Média': 'mean', 'Máximo': 'max', 'Mínimo': 'min', 'Desvio padrão': 'std', 'Magnitude': 'abs'}
+heatmap_options = {'max_cells': charts.HEATMAP_MAX_CELLS, 'rank_by': 'mean', 'cluster': False}
+if alternative_visualizations.get(selected_metric):
+  st.sidebar.header('Mapa de calor')
+  heatmap_options['max_cells'] = st.sidebar.number_input('Máximo de células', min_value=20, value=charts.HEATMAP_MAX_CELLS, step=100)
+  heatmap_options['rank_by'] = heatmap_rank_map[st.sidebar.selectbox('Empresas mantidas por', list(heatmap_rank_map))]
+  if charts.CLUSTERING:
+    heatmap_options['cluster'] = st.sidebar.checkbox('Ordenar por semelhança')
+
 ##------------------------------------------------------------------------------------------------------------------------------------------
 st.title(f'Indicadores de {selected_metric.lower().capitalize()}')
 ## APPLYING FILTERS--------------------------------------------------------------------------------------------------------------------------
-data = data[(data['DT_FIM_EXERC'] >= min_year) & (data['DT_FIM_EXERC'] <= max_year)]
-if (selected_companies): data = data[data['DENOM_CIA'].isin(selected_companies)]
+with perf.stage('filters'):
+  if selected_metric != 'INSIGHTS':
+    rows = storage.select_rows(full_data, selected_category, min_year, max_year, companies=selected_companies)
+  else:
+    # No INSIGHTS a seleção da barra lateral é de segmentos
+    rows = storage.select_rows(full_data, min_year=min_year, max_year=max_year, categories=selected_companies)
+  data = schema.remove_unused_categories(full_data.take(rows))
+# scope_version só muda quando um delta cruza o segmento e os anos filtrados; as figuras e
+# lacunas em cache de outros recortes continuam válidas
+filter_key = (selected_metric, selected_category, min_year, max_year, tuple(sorted(selected_companies)), storage.scope_version(state, selected_category, min_year, max_year))
 ##------------------------------------------------------------------------------------------------------------------------------------------
 
 diff = max_year - min_year + 1
 
-agg_map = {
-  'Soma': 'sum', 'Média': 'mean', 'Mínimo': 'min', 'Máximo': 'max', 'Mediana' :'median', 'Desvio padrão': 'std'
-}
-
+# Limite de painéis por figura nas grades por empresa; acima disso a grade é paginada
+PANELS_PER_PAGE = 20
+
+agg_map = cube.AGG_MAP
+comparative_options = ('Desvio padrão', 'Média', 'Soma', 'Mínimo', 'Máximo', 'Mediana')
+
+def aggregate(columns, func):
+  with perf.stage('aggregate', column=', '.join(columns), function=func):
+    return get_synced_cube().aggregate(columns, func, min_year, max_year, category=selected_category, companies=selected_companies)
+
+def paginate(companies, key):
+  pages = math.ceil(len(companies)/PANELS_PER_PAGE)
+  if pages <= 1: return list(companies)
+  page = st.number_input(f'Página (de {pages})', min_value=1, max_value=pages, key=key)
+  return list(companies[(page - 1) * PANELS_PER_PAGE:page * PANELS_PER_PAGE])
+
+def chart_fragment(fn):
+  # Cada bloco de gráfico é um fragmento: mudar um widget dele reexecuta só o bloco, sobre o data já filtrado
+  @st.fragment
+  @wraps(fn)
+  def fragment(*args, **kwargs):
+    timings = st.session_state.get('perf-timings')
+    if timings is None or not timings.finished:
+      return fn(*args, **kwargs)
+    run = st.session_state['perf-timings'] = perf.Timings(enabled=timings.enabled)
+    with run.stage('fragment', name=fn.__name__):
+      fn(*args, **kwargs)
+    run.write(PERF_LOG, kind='fragment', fragment=fn.__name__, metric=selected_metric, filters=filter_key)
+  return fragment
+
+@chart_fragment
 def plot_chat(title, x='DT_FIM_EXERC', y=None, color='DENOM_CIA', barmode=None):
   if runtime_vars[f'VISUALIZATION {y}'] == visualization_keys['lines']:
     plot_line(title, y=y, x=x, color=color)
   elif runtime_vars[f'VISUALIZATION {y}'] == visualization_keys['heatmap']:
-    heat_base = data.pivot(index='DENOM_CIA', columns='DT_FIM_EXERC', values=[y])
-    plot_heatmap(y, base=heat_base)
+    plot_heatmap(y, column=y)
   elif runtime_vars[f'VISUALIZATION {y}'] == visualization_keys['column']:
     col1, _ = st.columns(2)
 
@@ -161,70 +235,136 @@ def plot_chat(title, x='DT_FIM_EXERC', y=None, color='DENOM_CIA', barmode=None):
       f'{title} função agregação:',
       ('Desvio padrão', 'Média', 'Soma', 'Mínimo', 'Máximo', 'Mediana'))
 
-    column_base = data.groupby('DENOM_CIA').agg({y: agg_map[option]}).reset_index()
+    column_base = lambda : aggregate([y], agg_map[option])
     plot_column(f'{title} ({option})', y=y, base=column_base, barmode=barmode)
+  elif runtime_vars[f'VISUALIZATION {y}'] == visualization_keys['rank']:
+    plot_rank(title, column=y)
+
 
+# base pode ser um DataFrame ou uma função que o gera; a função só roda quando a figura não está no cache
+resolve_base = lambda base : data if base is None else base() if callable(base) else base
 
-def plot_column(title, x='DENOM_CIA', y='DENOM_CIA', base=None, barmode=None):
-  if base is None: base = data
-  fig = px.bar(
-    base,
-    x=x,
-    y=y,
-    title=title,
-    barmode=barmode
-  )
-  fig.update_xaxes(dtick=1, title_text='')
-  fig.update_yaxes(title_text='')
-  st.plotly_chart(fig, use_container_width=True)
+def show_figure(key, build):
+  def build_figure():
+    perf.note(cache='miss')
+    return build()
+
+  with perf.stage('figure', figure=key[0], title=str(key[1]), cache='hit'):
+    fig = get_figure_cache().get((*key, filter_key), build_figure)
+  with perf.stage('plotly_chart', figure=key[0], title=str(key[1]), bytes=charts.figure_size(fig) if perf.current().enabled else None):
+    st.plotly_chart(fig, use_container_width=True)
+
+
+def plot_column(title, x='DENOM_CIA', y='DENOM_CIA', base=None, barmode=None, cache_key=()):
+  build = lambda : charts.column_figure(resolve_base(base), title, x=x, y=y, barmode=barmode)
+  show_figure(('column', title, x, str(y), barmode, *cache_key), build)
 
 
 def plot_line(title, base=None, x='DT_FIM_EXERC', y='LUCRO LIQUIDO', color='DENOM_CIA'):
-  if base is None: base = data
   if diff == 1:
     plot_column(title, y=y, base=base)
   else:
-    fig = px.line(
-      base,
-      x=x,
-      y=y,
-      color=color,
-      title=title,
-    )
-    fig.update_xaxes(dtick=1, title_text='')
-    fig.update_yaxes(title_text='')
-    st.plotly_chart(fig, use_container_width=True)
+    build = lambda : charts.line_figure(resolve_base(base), title, x=x, y=y, color=color)
+    show_figure(('line', title, x, str(y), color), build)
 
-def plot_heatmap(title, base=None, y=None):
-  if base is None or diff == 1: base = data
+def plot_heatmap(title, column, y=None):
   if diff == 1:
-    plot_column(title, y=y, base=base)
+    plot_column(title, y=y, base=data)
+  elif data.empty:
+    st.write(f'{title}: sem dados no período selecionado.')
   else:
-    fig = px.imshow(
-      base,
-      labels={'color': 'valor', 'DENOM_CIA': 'Empresa'},
-      x=base.columns.get_level_values(1),
-      y=base.index,
-      title=title,
-    )
-    fig.update_xaxes(dtick=1, title_text='')
-    fig.update_yaxes(title_text='')
-    st.plotly_chart(fig, use_container_width=True)
+    def heatmap():
+      with perf.stage('pivot', column=column):
+        matrix, omitted, bucketed = charts.heatmap_matrix(data, column, **heatmap_options)
+        perf.note(omitted=omitted)
+      return charts.heatmap_figure(matrix, charts.heatmap_title(title, omitted, bucketed))
+    show_figure(('heatmap', title, *heatmap_options.values()), heatmap)
+
+
+def plot_rank(title, column):
+  def rank_base():
+    with perf.stage('rankings', column=column, cache='hit'):
+      ranks = get_synced_rankings().take(rows)
+    return rankings.peer_frame(data, ranks, column)
+
+  title = f'{title} (posição relativa no segmento)'
+  if diff == 1:
+    plot_column(title, y='PERCENTIL', base=rank_base)
+  else:
+    show_figure(('rank', title), lambda : charts.rank_figure(rank_base(), title))
 
 
 def plot_histogram(title, x='DENOM_CIA', y='DENOM_CIA', base=None, barmode=None):
-  if base is None: base = data
-  fig = px.histogram(
-    base,
-    x=x,
-    y=y,
-    title=title,
-    barmode=barmode,
-    labels=['DENOM_CIA']
-  )
-  fig.update_xaxes(dtick=1, title_text='')
-  fig.update_yaxes(title_text='')
-  st.plotly_chart(fig, use_container_width=True)
+  build = lambda : charts.histogram_figure(resolve_base(base), title, x=x, y=y, barmode=barmode)
+  show_figure(('histogram', title, x, str(y), barmode), build)
+
+
+@chart_fragment
+def plot_summary(title, columns):
+  col1, _, _, _ = st.columns(4)
+  with col1:
+    option = st.selectbox(
+    f'{title} função agregação:',
+    ('Desvio padrão', 'Média', 'Soma', 'Mínimo', 'Máximo', 'Mediana'))
+
+  base = aggregate(columns, agg_map[option])
+  for column in columns:
+    base[column] = base[column]/diff
+  plot_histogram(f'{title} ({option})', y=columns, barmode='group', base=base)
+
+
+@chart_fragment
+def plot_liquidity_grid():
+  companies = paginate(data['DENOM_CIA'].unique(), 'liquidity-page')
+  liquidity_grid = lambda : charts.liquidity_grid_figure(charts.company_groups(data, companies), data['CAPITAL CIRCULANTE LIQUIDO'].max()/100)
+  show_figure(('liquidity grid', tuple(companies)), liquidity_grid)
+
+
+@chart_fragment
+def plot_liability_pies():
+  companies = paginate(data['DENOM_CIA'].unique(), 'liability-page')
+
+  def liability_pies():
+    totals = data.groupby('DENOM_CIA', observed=True)[['EXIGIVEL A LONGO PRAZO', 'PASSIVO CIRCULANTE']].sum()
+    return charts.liability_pies_figure(totals.loc[companies])
+  show_figure(('liability pies', tuple(companies)), liability_pies)
+
+
+@chart_fragment
+def plot_gaps():
+  all_columns = st.checkbox('Todos os indicadores', key='gaps-all')
+  columns = schema.indicator_columns() if all_columns else schema.get_groups()[selected_metric]
+  table = get_gaps(data, filter_key, tuple(columns))
+  if table.empty:
+    st.write('Nenhum valor ausente no período selecionado.')
+  else:
+    st.dataframe(table[['INDICADOR', 'DENOM_CIA', 'PERIODO']], hide_index=True, use_container_width=True)
+
+
+@chart_fragment
+def plot_similar():
+  groups = {name: columns for name, columns in schema.get_groups().items() if columns}
+  col1, col2, col3 = st.columns(3, gap='large')
+  with col1:
+    company = st.selectbox('Empresa de referência', data['DENOM_CIA'].unique(), key='similar-company')
+  with col2:
+    chosen = st.multiselect('Grupos de indicadores', list(groups), default=[selected_metric], key='similar-groups')
+  with col3:
+    k = st.number_input('Quantidade de empresas', min_value=1, max_value=50, value=10, key='similar-k')
+  same_segment = st.checkbox('Só empresas do mesmo segmento', key='similar-segment')
+
+  if company is None or not chosen:
+    st.write('Selecione a empresa e os grupos de indicadores.')
+    return
+  columns = list(dict.fromkeys(column for name in chosen for column in groups[name]))
+  with perf.stage('similarity', columns=len(columns), cache='hit'):
+    index = get_synced_similarity()
+    table = index.query(company, columns, min_year, max_year, k=k, category=selected_category if same_segment else None)
+  if table.empty:
+    st.write(f'{company} não tem valores desses indicadores entre {min_year} e {max_year}.')
+  else:
+    st.caption(f'Distância: raiz da média dos quadrados das diferenças entre indicadores padronizados, nos valores que as duas empresas têm ({min_year}-{max_year}).')
+    st.dataframe(table, hide_index=True, use_container_width=True)
 
 
 # Tab de LIQUIDEZ
@@ -233,7 +373,7 @@ if selected_metric == 'LIQUIDEZ':
   with col1: plot_chat('Ativo Circulante', y='ATIVO CIRCULANTE')
   with col2: plot_chat('Passivo Circulante', y='PASSIVO CIRCULANTE')
 
-  base = data.groupby('DENOM_CIA').agg({'PASSIVO CIRCULANTE': 'sum', 'ATIVO CIRCULANTE': 'sum'}).reset_index()
+  base = aggregate(['PASSIVO CIRCULANTE', 'ATIVO CIRCULANTE'], 'sum')
   base['ATIVO CIRCULANTE'] = base['ATIVO CIRCULANTE']/diff
   base['PASSIVO CIRCULANTE'] = base['PASSIVO CIRCULANTE']/diff
   plot_histogram('Média do Ativo e Passivo Circulante', y=['ATIVO CIRCULANTE', 'PASSIVO CIRCULANTE'], barmode='group', base=base)
@@ -243,44 +383,7 @@ if selected_metric == 'LIQUIDEZ':
   plot_chat('Liquidez Corrente', y='LIQUIDEZ CORRENTE')
 
   st.header('Relação Capital Circulante & Liquidez Corrente (normalized)')
-  companies = data['DENOM_CIA'].unique()
-  get_rows = lambda : math.ceil(len(companies)/2) if len(companies) > 1 else 1
-  fig = make_subplots(
-    rows=get_rows(),
-    cols=2,
-    shared_xaxes=True,
-    subplot_titles=companies,
-    vertical_spacing=(1/(get_rows() - 1)) * 0.4 if get_rows() > 1 else 0.4
-  )
-  for i, company in enumerate(companies, start=1):
-    base = data[data['DENOM_CIA'] == company]
-    if i % 2 != 0: col = 1
-    else: col = 2
-    row = math.ceil(i/2)
-    factor = data['CAPITAL CIRCULANTE LIQUIDO'].max()/100
-
-    fig.add_trace(
-      go.Bar(
-        x=base['DT_FIM_EXERC'],
-        y=base['CAPITAL CIRCULANTE LIQUIDO'],
-        name='Capital Circulante',
-        marker_color='blue',
-      ),
-      row=row, col=col,
-    )
-
-    fig.add_trace(
-      go.Scatter(
-        x=base['DT_FIM_EXERC'],
-        y=base['LIQUIDEZ CORRENTE'] * factor,
-        mode='lines',
-        name='LIQUIDEZ CORRENTE',
-        line=dict(color='red', width=2),
-      ),
-      row=row, col=col,
-    )
-  fig.update_layout(showlegend=False)
-  st.plotly_chart(fig, use_container_width=True)
+  plot_liquidity_grid()
 
 
 # Tab de ENDIVIDAMENTO
@@ -294,34 +397,12 @@ if selected_metric == 'ENDIVIDAMENTO':
   plot_line('Capitais de longo prazo', y='CAPITAIS DE LONGO PRAZO')
 
   st.header('Composição do passivo total')
-  companies = [f'{company.split(" ")[0]} {company.split(" ")[1]}' for company in data['DENOM_CIA'].unique()]
-  fig = make_subplots(rows=1, cols=len(companies), subplot_titles=companies, specs=[[{'type': 'pie'}] * len(companies)], print_grid=True)
-  for i, cia in enumerate(data['DENOM_CIA'].unique()):
-    base = data[data['DENOM_CIA'] == cia]
-    fig.add_trace(
-      go.Pie(
-        labels=['EXIGIVEL A LONGO PRAZO', 'PASSIVO CIRCULANTE'],
-        values=[base['EXIGIVEL A LONGO PRAZO'].sum(), base['PASSIVO CIRCULANTE'].sum()],
-      ),
-      row=1,
-      col=i + 1
-    )
-  fig.update_layout(showlegend=False)
-  st.plotly_chart(fig, use_container_width=True)
+  plot_liability_pies()
 
 
 # Tab de COBERTURA
 if selected_metric == 'COBERTURA': 
-  col1, _, _, _ = st.columns(4)
-  with col1:
-    option = st.selectbox(
-    f'Cobertura de juros e Caixa operações função agregação:',
-    ('Desvio padrão', 'Média', 'Soma', 'Mínimo', 'Máximo', 'Mediana'))
-
-  base = data.groupby('DENOM_CIA').agg({'COBERTURA DE JUROS': agg_map[option], 'COBERTURA DE JUROS (CAIXA OPERAÇÕES)': agg_map[option]}).reset_index()
-  base['COBERTURA DE JUROS'] = base['COBERTURA DE JUROS']/diff
-  base['COBERTURA DE JUROS (CAIXA OPERAÇÕES)'] = base['COBERTURA DE JUROS (CAIXA OPERAÇÕES)']/diff
-  plot_histogram(f'Cobertura de juros e Caixa operações ({option})', y=['COBERTURA DE JUROS (CAIXA OPERAÇÕES)', 'COBERTURA DE JUROS'], barmode='group', base=base)
+  plot_summary('Cobertura de juros e Caixa operações', ['COBERTURA DE JUROS (CAIXA OPERAÇÕES)', 'COBERTURA DE JUROS'])
  
   plot_chat('Cobertura de juros', y='COBERTURA DE JUROS')
   plot_chat('Cobertura de juros (Caixa operações)', y='COBERTURA DE JUROS (CAIXA OPERAÇÕES)', )
@@ -329,16 +410,7 @@ if selected_metric == 'COBERTURA':
 
 # Tab de LUCRATIVIDADE
 if selected_metric == 'LUCRATIVIDADE':
-  col1, _, _, _ = st.columns(4)
-  with col1:
-    option = st.selectbox(
-    f'Margem Líquida e Margem Operacional função agregação:',
-    ('Desvio padrão', 'Média', 'Soma', 'Mínimo', 'Máximo', 'Mediana'))
-
-  base = data.groupby('DENOM_CIA').agg({'MG_LIQ': agg_map[option], 'MG_OP': agg_map[option]}).reset_index()
-  base['MG_LIQ'] = base['MG_LIQ']/diff
-  base['MG_OP'] = base['MG_OP']/diff
-  plot_histogram(f'Margem Líquida e Margem Operacional ({option})', y=['MG_OP', 'MG_LIQ'], barmode='group', base=base)
+  plot_summary('Margem Líquida e Margem Operacional', ['MG_OP', 'MG_LIQ'])
 
   col1, col2 = st.columns(2, gap="large")
   with col1:
@@ -351,16 +423,7 @@ if selected_metric == 'LUCRATIVIDADE':
 
 # Tab de ESTRUTURAIS
 if selected_metric == 'ESTRUTURAIS':
-  col1, _, _, _ = st.columns(4)
-  with col1:
-    option = st.selectbox(
-    f'Custo da mercadoria vendida e Despesas operacionais % função agregação:',
-    ('Desvio padrão', 'Média', 'Soma', 'Mínimo', 'Máximo', 'Mediana'))
-
-  base = data.groupby('DENOM_CIA').agg({'CUSTO DA MERCADORIA VENDIDA %': agg_map[option], 'DESPESAS OPERACIONAIS %': agg_map[option]}).reset_index()
-  base['CUSTO DA MERCADORIA VENDIDA %'] = base['CUSTO DA MERCADORIA VENDIDA %']/diff
-  base['DESPESAS OPERACIONAIS %'] = base['DESPESAS OPERACIONAIS %']/diff
-  plot_histogram(f'Custo da mercadoria vendida e Despesas operacionais % ({option})', y=['DESPESAS OPERACIONAIS %', 'CUSTO DA MERCADORIA VENDIDA %'], barmode='group', base=base)
+  plot_summary('Custo da mercadoria vendida e Despesas operacionais %', ['DESPESAS OPERACIONAIS %', 'CUSTO DA MERCADORIA VENDIDA %'])
 
   col1, col2 = st.columns(2, gap="large")
   with col1:
@@ -374,27 +437,7 @@ if selected_metric == 'ESTRUTURAIS':
 
 # Tab de RETORNO
 if selected_metric == 'RETORNO':
-  col1, _, _, _ = st.columns(4)
-  with col1:
-    option = st.selectbox(
-    f'Retorno Sobre os Ativos e Patrimônio função agregação:',
-    ('Desvio padrão', 'Média', 'Soma', 'Mínimo', 'Máximo', 'Mediana'))
-
-  base = data.groupby('DENOM_CIA').agg({'ROA': agg_map[option], 'ROE': agg_map[option]}).reset_index()
-  base['ROA'] = base['ROA']/diff
-  base['ROE'] = base['ROE']/diff
-  plot_histogram(f'Retorno Sobre os Ativos e Patrimônio ({option})', y=['ROE', 'ROA'], barmode='group', base=base)
-
-  uninvestment_companies = data[data['ROI'].isna()]['DENOM_CIA'].unique()
-  year_intervals = []
-  comps = []
-  relation = {}
-
-  for company in uninvestment_companies:
-    base = data[data['DENOM_CIA'] == company][data['ROI'].isna()]
-    intervals = find_closed_intervals(base['DT_FIM_EXERC'].unique())
-    comps.extend([company] * len(intervals))
-    year_intervals.extend(intervals)
+  plot_summary('Retorno Sobre os Ativos e Patrimônio', ['ROE', 'ROA'])
 
   col1, col2 = st.columns(2, gap="large")
   with col1:
@@ -404,67 +447,73 @@ if selected_metric == 'RETORNO':
 
   plot_chat('Retorno Sobre o Investimento', y='ROI')
 
-  fig = go.Figure(
-    data=[go.Table(header=dict(values=['Empresa', 'Período'], fill_color='rgb(0, 104, 201)', line_color='darkslategray'),
-    cells=dict(values=[comps, year_intervals], fill_color='rgb(120, 120, 120)'))
-  ])
-  fig.update_layout(title="Empresas sem investimento em algum período")
-  st.plotly_chart(fig, use_container_width=True)
+  roi_gaps = get_gaps(data, filter_key, ('ROI',))
+  st.plotly_chart(charts.gaps_table_figure(roi_gaps, 'Empresas sem investimento em algum período'), use_container_width=True)
 
 
 # Tab de ATIVIDADE
 if selected_metric == 'ATIVIDADE':
-  col1, _, _, _ = st.columns(4)
-  with col1:
-    option = st.selectbox(
-    f'Giro dos valores a receber e pagar função agregação:',
-    ('Desvio padrão', 'Média', 'Soma', 'Mínimo', 'Máximo', 'Mediana'))
-
-  base = data.groupby('DENOM_CIA').agg({'GIRO DE VALORES A RECEBER': agg_map[option], 'GIRO DE DUPLICATAS A PAGAR': agg_map[option]}).reset_index()
-  base['GIRO DE VALORES A RECEBER'] = base['GIRO DE VALORES A RECEBER']/diff
-  base['GIRO DE DUPLICATAS A PAGAR'] = base['GIRO DE DUPLICATAS A PAGAR']/diff
-  plot_histogram(f'Giro dos valores a receber e pagar ({option})', y=['GIRO DE DUPLICATAS A PAGAR', 'GIRO DE VALORES A RECEBER'], barmode='group', base=base)
+  plot_summary('Giro dos valores a receber e pagar', ['GIRO DE DUPLICATAS A PAGAR', 'GIRO DE VALORES A RECEBER'])
 
   plot_chat('Giro', y='GIRO')
   plot_chat('Giro dos valores a receber', y='GIRO DE VALORES A RECEBER')
   plot_chat('Giro dos valores a pagar', y='GIRO DE DUPLICATAS A PAGAR')
 
 
+# Lacunas nos dados (qualquer aba exceto INSIGHTS)
+if selected_metric != 'INSIGHTS':
+  with st.expander('Lacunas nos dados'): plot_gaps()
+  with st.expander('Empresas semelhantes'): plot_similar()
+
+
 # Tab de INSIGHTS
+@chart_fragment
+def plot_comparative(i):
+  columns = list(data.columns)
+  columns.remove('TIPO')
+  columns.remove('DENOM_CIA')
+  columns.remove('DT_FIM_EXERC')
+  col1, col2, col3 = st.columns(3, gap='large')
+  with col1:
+    name = st.text_input('Nome do comparativo', placeholder='Insira um nome para o comparativo', key=f'name-{i}')
+  with col2:
+    comparative = st.selectbox(f'Agregação para {name}', comparative_options, key=f'comparative-{i}')
+  with col3:
+    columns = st.multiselect(f'Colunas do comparativo {name}', columns, placeholder=f'Comparativo {i +1}',  key=f'columns-{i}')
+
+  if not columns:
+    st.write(f'Selecione as colunas para realizar o comparativo "{name}"')
+  else:
+    # Normalmente já está no cache do planner pelo lote montado antes dos fragmentos
+    column_base = lambda : get_planner().get(data, filter_key, tuple(columns), agg_map[comparative])
+    plot_column(f'Resultado de {name}', x='TIPO', y=columns, base=column_base, barmode='group', cache_key=(comparative,))
+
+
 if selected_metric == 'INSIGHTS':
-  columns = list(get_data().columns)
+  columns = list(full_data.columns)
   columns.remove('TIPO')
   columns.remove('DENOM_CIA')
   columns.remove('DT_FIM_EXERC')
   comparatives_len = st.number_input('Quantidade de comparativos', min_value=1, max_value=len(columns))
-  data = get_data()
-  data = data[(data['DT_FIM_EXERC'] >= min_year) & (data['DT_FIM_EXERC'] <= max_year)]
-  if len(selected_companies) > 0: data = data[data['TIPO'].isin(selected_companies)]
+
+  # Todos os comparativos num lote só: um groupby para os pares (coluna, função) que ainda não estão em cache
+  queries = [
+    (tuple(st.session_state.get(f'columns-{i}', ())), agg_map[st.session_state.get(f'comparative-{i}', comparative_options[0])])
+    for i in range(comparatives_len)
+  ]
+  with perf.stage('insights batch', queries=len(queries)):
+    get_planner().prefetch(data, filter_key, [query for query in queries if query[0]])
 
   for i in range(comparatives_len):
-    columns = list(data.columns)
-    columns.remove('TIPO')
-    columns.remove('DENOM_CIA')
-    columns.remove('DT_FIM_EXERC')
-    col1, col2, col3 = st.columns(3, gap='large')
-    with col1:
-      name = st.text_input('Nome do comparativo', placeholder='Insira um nome para o comparativo', key=f'name-{i}')
-    with col2:
-      comparative = st.selectbox(
-        f'Agregação para {name}',
-        ('Desvio padrão', 'Média', 'Soma', 'Mínimo', 'Máximo', 'Mediana'),
-        key=f'comparative-{i}'
-      )
-    with col3:
-      columns = st.multiselect(f'Colunas do comparativo {name}', columns, placeholder=f'Comparativo {i +1}',  key=f'columns-{i}')
-
-    base = data[columns]
-    obj = {}
-    for column in columns:
-      obj[column] = agg_map[comparative]
-
-    if not dict.keys(obj):
-      st.write(f'Selecione as colunas para realizar o comparativo "{name}"')
-    else:
-      column_base = data.groupby('TIPO').agg(obj).reset_index()
-      plot_column(f'Resultado de {name}', x='TIPO', y=columns, base=column_base, barmode='group')
+    plot_comparative(i)
+
+
+## DESEMPENHO--------------------------------------------------------------------------------------------------------------------------------
+with st.sidebar.expander('Desempenho'):
+  st.checkbox('Medir este rerun', key='perf-enabled')
+  if timings.enabled:
+    stats = get_figure_cache().stats()
+    batches = get_planner().stats()
+    st.caption(f'Total: {timings.total_ms():.0f} ms · cache de figuras: {stats["hits"]} acertos, {stats["misses"]} faltas, {stats["bytes"] / 1024:.0f} KiB · comparativos: {batches["passes"]} passadas, {batches["entries"]} resultados')
+    st.dataframe(pd.DataFrame(timings.records).round({'ms': 1}), hide_index=True, use_container_width=True)
+timings.write(PERF_LOG, kind='rerun', metric=selected_metric, filters=filter_key)
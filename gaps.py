@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['INDICADOR', 'DENOM_CIA', 'INICIO', 'FIM', 'PERIODO']
+
+is_missing = lambda values : values.isna()
+below = lambda threshold : lambda values : values < threshold
+above = lambda threshold : lambda values : values > threshold
+
+
+def format_interval(start, end):
+  return str(start) if start == end else f'{start}-{end}'
+
+
+def find_gaps(data, columns, condition=is_missing, company='DENOM_CIA', year='DT_FIM_EXERC'):
+  columns = list(columns)
+  rows, positions = np.nonzero(condition(data[columns]).to_numpy())
+  if len(rows) == 0:
+    return pd.DataFrame({column: [] for column in COLUMNS})
+
+  codes, companies = pd.factorize(data[company].to_numpy()[rows])
+  flagged = pd.DataFrame({
+    'column': positions,
+    'company': codes,
+    'year': data[year].to_numpy()[rows].astype(np.int64),
+    'row': rows,
+  }).drop_duplicates(['column', 'company', 'year'])
+
+  # Empresas na ordem em que a primeira lacuna de cada indicador aparece, anos em ordem crescente
+  flagged['first'] = flagged.groupby(['column', 'company'])['row'].transform('min')
+  flagged = flagged.sort_values(['column', 'first', 'year'])
+
+  column, first, years = (flagged[key].to_numpy() for key in ('column', 'first', 'year'))
+  starts = np.ones(len(flagged), dtype=bool)
+  starts[1:] = (column[1:] != column[:-1]) | (first[1:] != first[:-1]) | (years[1:] != years[:-1] + 1)
+  start_positions = np.flatnonzero(starts)
+  end_positions = np.append(start_positions[1:], len(flagged)) - 1
+
+  start_years, end_years = years[start_positions], years[end_positions]
+  return pd.DataFrame({
+    'INDICADOR': np.array(columns, dtype=object)[column[start_positions]],
+    'DENOM_CIA': np.asarray(companies, dtype=object)[flagged['company'].to_numpy()[start_positions]],
+    'INICIO': start_years,
+    'FIM': end_years,
+    'PERIODO': [format_interval(start, end) for start, end in zip(start_years, end_years)],
+  })
@@ -0,0 +1,71 @@
+import json
+import threading
+import time
+from contextlib import nullcontext
+
+NULL_STAGE = nullcontext()
+local = threading.local()
+
+
+class Stage:
+  def __init__(self, timings, name, info):
+    self.timings = timings
+    self.record = {'stage': name, 'ms': None, **info}
+
+  def __enter__(self):
+    self.timings.records.append(self.record)
+    self.timings.active.append(self.record)
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.record['ms'] = (time.perf_counter() - self.start) * 1000
+    self.timings.active.pop()
+    return False
+
+  def note(self, **info):
+    self.record.update(info)
+
+
+class Timings:
+  # Um objeto por rerun. Desligado, stage() devolve sempre o mesmo nullcontext e não mede nada
+  def __init__(self, enabled=False):
+    self.enabled = enabled
+    self.records = []
+    self.active = []
+    self.start = time.perf_counter()
+    self.finished = False
+    local.timings = self
+
+  def stage(self, name, **info):
+    if not self.enabled: return NULL_STAGE
+    return Stage(self, name, info)
+
+  def note(self, **info):
+    if self.enabled and self.active: self.active[-1].update(info)
+
+  def total_ms(self):
+    return (time.perf_counter() - self.start) * 1000
+
+  def write(self, path, **context):
+    self.finished = True
+    if not self.enabled: return
+    line = {'time': time.time(), 'total_ms': self.total_ms(), **context, 'stages': self.records}
+    with open(path, 'a', encoding='utf-8') as file:
+      file.write(json.dumps(line, ensure_ascii=False, default=str) + '\n')
+
+
+def current():
+  return getattr(local, 'timings', None)
+
+
+def stage(name, **info):
+  timings = current()
+  if timings is None: return NULL_STAGE
+  return timings.stage(name, **info)
+
+
+def note(**info):
+  # Para código que não recebe o Timings (ex.: corpo de funções com st.cache_data)
+  timings = current()
+  if timings is not None: timings.note(**info)
@@ -0,0 +1,85 @@
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+
+class ComparativePlanner:
+  # Os comparativos do INSIGHTS viram um lote: os pares (coluna, função) que faltam no cache
+  # saem de um único groupby sobre o frame compartilhado, e cada par fica guardado pelo recorte
+  def __init__(self, group='TIPO', max_entries=1024):
+    self.group = group
+    self.max_entries = max_entries
+    self.entries = OrderedDict()
+    self.passes = 0
+    self.lock = threading.Lock()
+
+  def prefetch(self, data, scope, queries):
+    # scope identifica o frame (anos, filtro de TIPO, versão dos dados); queries é uma lista de (colunas, função)
+    with self.lock:
+      missing = list(dict.fromkeys(
+        (column, func) for columns, func in queries for column in columns
+        if (scope, column, func) not in self.entries
+      ))
+    if not missing: return
+
+    # Os grupos são fatorados uma vez; cada função distinta roda uma vez sobre todas as suas colunas
+    by_func = {}
+    for column, func in missing: by_func.setdefault(func, []).append(column)
+    grouped = data.groupby(self.group, observed=True)
+    results = {func: grouped[columns].agg(func) for func, columns in by_func.items()}
+
+    with self.lock:
+      self.passes += 1
+      for column, func in missing:
+        self.entries[(scope, column, func)] = results[func][column]
+      while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+
+  def get(self, data, scope, columns, func):
+    # Mesmo formato de data.groupby(group).agg({coluna: func}).reset_index()
+    self.prefetch(data, scope, [(columns, func)])
+    with self.lock:
+      series = []
+      for column in columns:
+        self.entries.move_to_end((scope, column, func))
+        series.append(self.entries[(scope, column, func)])
+    return pd.concat(series, axis=1).reset_index()
+
+  def run(self, data, scope, queries):
+    self.prefetch(data, scope, queries)
+    return [self.get(data, scope, columns, func) for columns, func in queries]
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def stats(self):
+    with self.lock:
+      return {'entries': len(self.entries), 'passes': self.passes}
+
+
+if __name__ == '__main__':
+  import itertools
+  import time
+
+  import schema
+  import storage
+
+  # Confere contra um groupby por comparativo e mede o lote contra as consultas separadas
+  data = storage.load_data()
+  columns = schema.indicator_columns()
+  functions = ['std', 'mean', 'sum', 'min', 'max', 'median']
+  queries = [(tuple(columns[i:i + 3]), func) for i, func in zip(range(0, len(columns), 3), itertools.cycle(functions))]
+  planner = ComparativePlanner()
+  start = time.perf_counter()
+  results = planner.run(data, 'todos', queries)
+  elapsed = time.perf_counter() - start
+  for (query_columns, func), result in zip(queries, results):
+    expected = data.groupby('TIPO', observed=True).agg({column: func for column in query_columns}).reset_index()
+    pd.testing.assert_frame_equal(result, expected)
+
+  start = time.perf_counter()
+  for query_columns, func in queries:
+    data.groupby('TIPO', observed=True).agg({column: func for column in query_columns}).reset_index()
+  separate = time.perf_counter() - start
+  print(f'{len(queries)} comparativos: lote em {elapsed * 1000:.1f} ms ({planner.stats()["passes"]} passada), separados em {separate * 1000:.1f} ms')
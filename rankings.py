@@ -0,0 +1,93 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+MEASURES = ['PERCENTIL', 'ZSCORE', 'QUARTIL']
+
+
+def peer_rankings(data, columns, group=('TIPO', 'DT_FIM_EXERC')):
+  # Posição de cada empresa entre os pares do mesmo segmento e ano, para todos os indicadores
+  # de uma vez. Linhas alinhadas com data; colunas (indicador, medida)
+  columns = list(columns)
+  values = data[columns].astype('float64').replace([np.inf, -np.inf], np.nan)
+  grouped = values.groupby([data[key] for key in group], observed=True, sort=False)
+  # Percentil 0-100 (empates com o posto médio); z-score com o desvio amostral do grupo
+  percentile = grouped.rank(pct=True) * 100
+  zscore = (values - grouped.transform('mean')) / grouped.transform('std')
+  quartile = np.ceil(percentile / 25).clip(1, 4)
+  result = pd.concat([percentile, zscore, quartile], axis=1, keys=MEASURES).astype('float32')
+  return result.swaplevel(axis=1)[[(column, measure) for column in columns for measure in MEASURES]]
+
+
+class PeerRankings:
+  # peer_rankings da base inteira, mantido em dia por delta: só os grupos (segmento, ano) que o
+  # delta toca são recalculados; as outras linhas são reaproveitadas pelo índice
+  def __init__(self, data, columns, group=('TIPO', 'DT_FIM_EXERC'), version=0):
+    self.columns = list(columns)
+    self.group = list(group)
+    self.frame = peer_rankings(data, self.columns, self.group)
+    self.version = version
+    self.lock = threading.Lock()
+
+  def update(self, data, rows):
+    # data já inclui rows (e pode ter sido reordenado por ano). O frame anterior não é alterado:
+    # quem ainda o usa continua com os números da versão dele
+    keys = pd.MultiIndex.from_arrays([data[column] for column in self.group])
+    positions = np.flatnonzero(keys.isin(pd.MultiIndex.from_arrays([rows[column] for column in self.group])))
+    frame = self.frame.reindex(data.index)
+    frame.iloc[positions] = peer_rankings(data.iloc[positions], self.columns, self.group).to_numpy()
+    self.frame = frame
+
+  def sync(self, data, version, load):
+    # load(inicio) devolve as linhas dos deltas a partir de inicio; várias sessões podem chamar juntas
+    with self.lock:
+      if self.version >= version: return self.frame
+      rows = load(self.version)
+      if rows is not None: self.update(data, rows)
+      self.version = version
+      return self.frame
+
+
+def peer_frame(data, rankings, column, company='DENOM_CIA', year='DT_FIM_EXERC'):
+  # rankings já recortado nas mesmas linhas de data
+  measures = rankings[column]
+  return data[[company, year]].assign(**{measure: measures[measure].to_numpy() for measure in MEASURES})
+
+
+if __name__ == '__main__':
+  import time
+
+  import schema
+  import storage
+
+  # Confere contra um laço por grupo e mede o cálculo sobre a base inteira
+  data = storage.load_data()
+  columns = schema.indicator_columns()
+  start = time.perf_counter()
+  rankings = peer_rankings(data, columns)
+  elapsed = time.perf_counter() - start
+
+  for column in columns[::4]:
+    for _, rows in data.groupby(['TIPO', 'DT_FIM_EXERC'], observed=True).groups.items():
+      values = data.loc[rows, column].astype('float64').replace([np.inf, -np.inf], np.nan)
+      valid = values.dropna()
+      expected = valid.rank() / len(valid) * 100
+      got = rankings.loc[rows, (column, 'PERCENTIL')]
+      np.testing.assert_allclose(got[valid.index], expected, rtol=1e-5)
+      assert got[values.isna()].isna().all()
+      if len(valid) > 1:
+        zscore = (valid - valid.mean()) / valid.std()
+        np.testing.assert_allclose(rankings.loc[valid.index, (column, 'ZSCORE')], zscore, rtol=1e-4, atol=1e-4)
+      quartiles = rankings.loc[valid.index, (column, 'QUARTIL')]
+      assert quartiles.between(1, 4).all()
+
+  # Por delta: o último ano de um segmento e o primeiro de algumas empresas chegam depois
+  last = (data['TIPO'] == data['TIPO'].iloc[-1]) & (data['DT_FIM_EXERC'] == data['DT_FIM_EXERC'].max())
+  first = data['DENOM_CIA'].isin(data['DENOM_CIA'].unique()[:3]) & (data['DT_FIM_EXERC'] == data['DT_FIM_EXERC'].min())
+  incremental = PeerRankings(data[~(last | first)], columns)
+  start = time.perf_counter()
+  incremental.update(data, data[last | first])
+  updated = time.perf_counter() - start
+  pd.testing.assert_frame_equal(incremental.frame, rankings)
+  print(f'{len(columns)} indicadores x {len(data)} linhas em {elapsed * 1000:.1f} ms; delta de {int((last | first).sum())} linhas em {updated * 1000:.1f} ms')
@@ -0,0 +1,143 @@
+import argparse
+import html
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import plotly
+
+import charts
+import cube
+import gaps
+import schema
+import storage
+
+PANELS_PER_PAGE = 20
+
+# Estado de cada processo do pool: cada um mapeia as colunas do store (as páginas são as mesmas
+# para todos os processos), em vez de receber uma cópia serializada do dataset
+worker = {}
+
+
+def init_worker():
+  data = storage.load_shared()
+  worker['data'] = data
+  worker['cube'] = cube.AggregationCube(data, schema.indicator_columns())
+  worker['groups'] = schema.get_groups()
+
+
+def select(data, segment, min_year, max_year):
+  return schema.remove_unused_categories(data.take(storage.select_rows(data, segment, min_year, max_year)))
+
+
+def page_figures(tab, segment, min_year, max_year):
+  data = select(worker['data'], segment, min_year, max_year)
+  figures = []
+  for column in worker['groups'][tab]:
+    means = worker['cube'].aggregate([column], 'mean', min_year, max_year, category=segment)
+    figures.append(charts.column_figure(means, f'{column} (Média)', y=column))
+    if min_year == max_year: continue
+    figures.append(charts.line_figure(data, column, y=column))
+    matrix, omitted, bucketed = charts.heatmap_matrix(data, column)
+    if matrix.size == 0: continue
+    figures.append(charts.heatmap_figure(matrix, charts.heatmap_title(column, omitted, bucketed)))
+
+  companies = list(data['DENOM_CIA'].unique())
+  pages = [companies[start:start + PANELS_PER_PAGE] for start in range(0, len(companies), PANELS_PER_PAGE)]
+  if tab == 'LIQUIDEZ':
+    factor = data['CAPITAL CIRCULANTE LIQUIDO'].max()/100
+    figures.extend(charts.liquidity_grid_figure(charts.company_groups(data, page), factor) for page in pages)
+  if tab == 'ENDIVIDAMENTO':
+    totals = data.groupby('DENOM_CIA', observed=True)[['EXIGIVEL A LONGO PRAZO', 'PASSIVO CIRCULANTE']].sum()
+    figures.extend(charts.liability_pies_figure(totals.loc[page]) for page in pages)
+
+  table = gaps.find_gaps(data, worker['groups'][tab])
+  for column, rows in table.groupby('INDICADOR', sort=False):
+    figures.append(charts.gaps_table_figure(rows, f'Lacunas em {column}'))
+  return figures
+
+
+def write_page(path, title, figures, plotlyjs):
+  body = ''.join(
+    fig.to_html(full_html=False, include_plotlyjs=plotlyjs if i == 0 else False)
+    for i, fig in enumerate(figures)
+  )
+  with open(path, 'w', encoding='utf-8') as file:
+    file.write(
+      f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>{html.escape(title)}</title></head>'
+      f'<body><h1>{html.escape(title)}</h1>{body}</body></html>'
+    )
+
+
+def render_page(tab, segment, min_year, max_year, output, plotlyjs):
+  start = time.perf_counter()
+  title = f'Indicadores de {tab.lower().capitalize()} - {segment} ({min_year}-{max_year})'
+  path = os.path.join(output, f'{tab}_{segment}_{min_year}-{max_year}.html')
+  write_page(path, title, page_figures(tab, segment, min_year, max_year), plotlyjs)
+  return path, time.perf_counter() - start
+
+
+def write_index(output, results, wall_time, workers):
+  rows = ''.join(
+    f'<tr><td><a href="{html.escape(os.path.basename(path))}">{html.escape(os.path.basename(path))}</a></td><td>{seconds * 1000:.0f}</td></tr>'
+    for path, seconds in sorted(results)
+  )
+  total = sum(seconds for _, seconds in results)
+  with open(os.path.join(output, 'index.html'), 'w', encoding='utf-8') as file:
+    file.write(
+      '<!DOCTYPE html><html><head><meta charset="utf-8"><title>Relatórios</title></head><body>'
+      f'<h1>Relatórios</h1><p>{len(results)} páginas em {wall_time:.2f} s com {workers} processos '
+      f'(soma dos tempos por página: {total:.2f} s)</p>'
+      f'<table><tr><th>Página</th><th>Tempo (ms)</th></tr>{rows}</table></body></html>'
+    )
+
+
+def parse_range(value):
+  start, _, end = value.partition('-')
+  return int(start), int(end or start)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Gera os relatórios estáticos de todas as abas e segmentos em HTML')
+  parser.add_argument('--output', default='reports')
+  parser.add_argument('--tabs', nargs='*', help='abas do agrupamento.json (padrão: todas com indicadores)')
+  parser.add_argument('--segments', nargs='*', help='valores de TIPO (padrão: todos)')
+  parser.add_argument('--ranges', nargs='*', type=parse_range, help='intervalos de anos, ex.: 2010-2022 2015-2022 (padrão: todo o período)')
+  parser.add_argument('--workers', type=int, default=os.cpu_count())
+  parser.add_argument(
+    '--plotlyjs', default='directory', choices=['directory', 'inline', 'cdn'],
+    help='directory grava um plotly.min.js na pasta de saída, usado por todas as páginas; inline embute o plotly.js em cada página; cdn carrega da internet',
+  )
+  args = parser.parse_args()
+
+  data = storage.load_shared()
+  tabs = args.tabs or [tab for tab, columns in schema.get_groups().items() if columns]
+  segments = args.segments or list(data['TIPO'].unique())
+  ranges = args.ranges or [(int(data['DT_FIM_EXERC'].min()), int(data['DT_FIM_EXERC'].max()))]
+  plotlyjs = True if args.plotlyjs == 'inline' else args.plotlyjs
+  os.makedirs(args.output, exist_ok=True)
+  if plotlyjs == 'directory':
+    # Uma cópia só, gravada antes das páginas; os relatórios abrem sem internet
+    with open(os.path.join(args.output, 'plotly.min.js'), 'w', encoding='utf-8') as file:
+      file.write(plotly.offline.get_plotlyjs())
+
+  start = time.perf_counter()
+  results = []
+  with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker) as pool:
+    futures = [
+      pool.submit(render_page, tab, segment, min_year, max_year, args.output, plotlyjs)
+      for tab in tabs for segment in segments for min_year, max_year in ranges
+    ]
+    for future in as_completed(futures):
+      path, seconds = future.result()
+      results.append((path, seconds))
+      print(f'{seconds * 1000:8.0f} ms  {path}')
+  wall_time = time.perf_counter() - start
+
+  write_index(args.output, results, wall_time, args.workers)
+  print(f'{len(results)} páginas em {wall_time:.2f} s com {args.workers} processos; média de {math.fsum(s for _, s in results) / max(len(results), 1) * 1000:.0f} ms por página')
+
+
+if __name__ == '__main__':
+  main()
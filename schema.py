@@ -0,0 +1,94 @@
+import json
+import os
+
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+GROUPS_PATH = os.path.join(BASE_DIR, 'agrupamento.json')
+MANIFEST_PATH = os.path.join(BASE_DIR, 'colunas.json')
+
+# Tipo de cada coluna do manifesto -> dtype em memória
+KIND_DTYPES = {
+  'categoria': 'category',
+  'ano': 'int16',
+  'valor': 'int64',
+  'indice': 'float64',
+}
+
+
+def load_json(path):
+  with open(path, encoding='utf-8') as file:
+    return json.load(file)
+
+
+def get_groups():
+  return load_json(GROUPS_PATH)
+
+
+def get_manifest():
+  manifest = load_json(MANIFEST_PATH)
+  unknown = [kind for kind in manifest.values() if kind not in KIND_DTYPES]
+  if unknown:
+    raise ValueError(f'Tipos de coluna desconhecidos em {MANIFEST_PATH}: {sorted(set(unknown))}')
+
+  missing = [column for columns in get_groups().values() for column in columns if column not in manifest]
+  if missing:
+    raise ValueError(f'Colunas de {GROUPS_PATH} ausentes em {MANIFEST_PATH}: {sorted(set(missing))}')
+  return manifest
+
+
+def columns_of(kind, manifest=None):
+  if manifest is None: manifest = get_manifest()
+  return [column for column, column_kind in manifest.items() if column_kind == kind]
+
+
+def indicator_columns(manifest=None):
+  if manifest is None: manifest = get_manifest()
+  return [column for column, kind in manifest.items() if kind in ('valor', 'indice')]
+
+
+def read_dtypes(manifest=None):
+  if manifest is None: manifest = get_manifest()
+  # Inteiros ficam com o parser (valores podem ter lacunas no universo completo) e são
+  # compactados no apply_schema, depois da ordenação por ano
+  return {column: KIND_DTYPES[kind] for column, kind in manifest.items() if kind in ('categoria', 'indice')}
+
+
+def apply_schema(data, float32=False, manifest=None):
+  if manifest is None: manifest = get_manifest()
+  dtypes = {}
+  for column, kind in manifest.items():
+    if column not in data.columns: continue
+    dtype = KIND_DTYPES[kind]
+    if kind == 'valor' and data[column].isna().any(): dtype = 'float64'
+    if kind == 'indice' and float32: dtype = 'float32'
+    dtypes[column] = dtype
+  return data.astype(dtypes)
+
+
+def remove_unused_categories(data):
+  # O plotly express agrupa sem observed=True; categorias vazias viram grupos inexistentes
+  columns = data.select_dtypes('category').columns
+  return data.assign(**{column: data[column].cat.remove_unused_categories() for column in columns})
+
+
+def memory_usage(data):
+  return int(data.memory_usage(index=True, deep=True).sum())
+
+
+def memory_report(before, after):
+  before_bytes, after_bytes = memory_usage(before), memory_usage(after)
+  return {
+    'antes': before_bytes,
+    'depois': after_bytes,
+    'reducao': 1 - after_bytes / before_bytes if before_bytes else 0,
+  }
+
+
+if __name__ == '__main__':
+  import storage
+
+  raw = pd.read_csv(storage.CSV_PATH)
+  for name, compact in (('float64', storage.load_data()), ('float32', storage.load_data(float32=True))):
+    report = memory_report(raw, compact)
+    print(f'{name}: {report["antes"] / 1024:.1f} KiB -> {report["depois"] / 1024:.1f} KiB ({report["reducao"]:.0%} menor)')
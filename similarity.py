@@ -0,0 +1,221 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['DENOM_CIA', 'TIPO', 'DISTANCIA', 'SOBREPOSICAO']
+
+
+class SimilarityIndex:
+  # Empresas como vetores (indicador, ano) normalizados. Cada indicador vira z-score sobre a base
+  # inteira (cortado em +-clip para que um valor extremo não domine a distância); lacunas ficam
+  # fora da distância por uma máscara em vez de virarem zero. O cubo guarda os valores crus e a
+  # média e a variância de cada indicador, para que um delta só escreva as suas células
+  def __init__(self, data, columns, company='DENOM_CIA', year='DT_FIM_EXERC', category='TIPO', clip=5, max_blocks=16, version=0):
+    self.columns = list(columns)
+    self.company, self.year, self.category = company, year, category
+    self.clip = clip
+    self.max_blocks = max_blocks
+    self.blocks = OrderedDict()
+    self.version = version
+    self.lock = threading.RLock()
+
+    companies = np.unique(data[company].to_numpy().astype(object))
+    years = data[year].to_numpy().astype(np.int64)
+    self.companies = companies
+    self.positions = {name: i for i, name in enumerate(companies)}
+    self.first_year = int(years.min())
+    self.years = int(years.max()) - self.first_year + 1
+    self.categories = np.empty(len(companies), dtype=object)
+    self.last_seen = np.full(len(companies), np.iinfo(np.int64).min, dtype=np.int64)
+    # Contagem, média e soma dos quadrados dos desvios de cada indicador, sobre as linhas
+    self.count = np.zeros(len(self.columns))
+    self.mean = np.zeros(len(self.columns))
+    self.m2 = np.zeros(len(self.columns))
+    # Empresa x indicador x ano; empresa-ano repetido fica com a última linha
+    self.cube = np.full((len(companies), len(self.columns), self.years), np.nan, dtype=np.float32)
+    self.write(data)
+
+  def write(self, rows):
+    # Segmento de cada empresa (o do último ano, se mudou)
+    codes = np.searchsorted(self.companies, rows[self.company].to_numpy().astype(object))
+    years = rows[self.year].to_numpy().astype(np.int64)
+    order = np.argsort(years, kind='stable')
+    latest = order[years[order] >= self.last_seen[codes[order]]]
+    self.categories[codes[latest]] = rows[self.category].to_numpy()[latest]
+    np.maximum.at(self.last_seen, codes, years)
+
+    values = rows[self.columns].to_numpy(dtype=np.float64)
+    values[~np.isfinite(values)] = np.nan
+    self.cube[codes, :, years - self.first_year] = values
+
+    # Combina as estatísticas das linhas novas com as que já havia (Chan et al.)
+    count = np.sum(~np.isnan(values), axis=0)
+    with np.errstate(invalid='ignore'):
+      mean = np.where(count > 0, np.nansum(values, axis=0) / np.maximum(count, 1), 0)
+    m2 = np.nansum((values - mean) ** 2, axis=0)
+    total = self.count + count
+    delta = mean - self.mean
+    with np.errstate(invalid='ignore', divide='ignore'):
+      self.mean = np.where(total > 0, self.mean + delta * count / total, 0)
+      self.m2 = np.where(total > 0, self.m2 + m2 + delta * delta * self.count * count / total, 0)
+    self.count = total
+
+  def update(self, data, rows):
+    # data já inclui rows. Empresas e anos novos aumentam o cubo (cópia das células, sem voltar
+    # às linhas antigas); os blocos normalizados são descartados porque a média e o desvio mudaram
+    with self.lock:
+      companies = np.union1d(self.companies, rows[self.company].to_numpy().astype(object))
+      years = rows[self.year].to_numpy().astype(np.int64)
+      first_year = min(self.first_year, int(years.min()))
+      last_year = max(self.first_year + self.years - 1, int(years.max()))
+      if len(companies) > len(self.companies) or last_year - first_year + 1 > self.years:
+        cube = np.full((len(companies), len(self.columns), last_year - first_year + 1), np.nan, dtype=np.float32)
+        moved = np.searchsorted(companies, self.companies)
+        offset = self.first_year - first_year
+        cube[moved, :, offset:offset + self.years] = self.cube
+        categories = np.empty(len(companies), dtype=object)
+        categories[moved] = self.categories
+        last_seen = np.full(len(companies), np.iinfo(np.int64).min, dtype=np.int64)
+        last_seen[moved] = self.last_seen
+        self.cube, self.categories, self.last_seen = cube, categories, last_seen
+        self.companies = companies
+        self.positions = {name: i for i, name in enumerate(companies)}
+        self.first_year, self.years = first_year, last_year - first_year + 1
+      self.write(rows)
+      self.blocks.clear()
+
+  def sync(self, data, version, load):
+    # load(inicio) devolve as linhas dos deltas a partir de inicio; várias sessões podem chamar juntas
+    with self.lock:
+      if self.version >= version: return
+      rows = load(self.version)
+      if rows is not None: self.update(data, rows)
+      self.version = version
+
+  def block(self, columns):
+    # Matriz densa de um conjunto de indicadores, com os anos por fora: um intervalo de anos é
+    # uma fatia contígua de colunas, sem cópia na consulta
+    columns = tuple(columns)
+    with self.lock:
+      if columns in self.blocks:
+        self.blocks.move_to_end(columns)
+        return self.blocks[columns]
+
+    indices = [self.columns.index(column) for column in columns]
+    selected = self.cube[:, indices, :].astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+      std = np.sqrt(self.m2[indices] / self.count[indices])
+      selected = np.clip((selected - self.mean[indices, None]) / std[:, None], -self.clip, self.clip)
+    selected = np.ascontiguousarray(selected.transpose(0, 2, 1)).reshape(len(self.companies), -1)
+    mask = ~np.isnan(selected)
+    values = np.where(mask, selected, 0).astype(np.float32)
+    block = (values, mask.astype(np.float32), values * values)
+
+    with self.lock:
+      self.blocks[columns] = block
+      while len(self.blocks) > self.max_blocks: self.blocks.popitem(last=False)
+    return block
+
+  def query(self, company, columns, min_year=None, max_year=None, k=10, min_overlap=0.5, category=None):
+    # Top-k empresas mais próximas de company: raiz da média dos quadrados das diferenças nos
+    # valores que as duas têm. Candidatas com menos de min_overlap dos valores da empresa ficam de fora
+    if company not in self.positions:
+      raise ValueError(f'Empresa desconhecida: {company}')
+    columns = tuple(columns)
+    first = 0 if min_year is None else max(0, int(min_year) - self.first_year)
+    last = self.years - 1 if max_year is None else min(self.years - 1, int(max_year) - self.first_year)
+    window = slice(first * len(columns), (last + 1) * len(columns))
+
+    values, mask, squares = (matrix[:, window] for matrix in self.block(columns))
+    target = self.positions[company]
+    target_values, target_mask = values[target], mask[target]
+    available = target_mask.sum()
+    if available == 0: return pd.DataFrame({column: [] for column in COLUMNS})
+
+    # sum(m * mt * (x - t)^2) expandido em três produtos matriz-vetor (x e t já são zero nas lacunas)
+    overlap = mask @ target_mask
+    distances = squares @ target_mask - 2 * (values @ target_values) + mask @ (target_values * target_values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+      distances = np.sqrt(np.maximum(distances, 0) / overlap)
+    eligible = (overlap >= max(1, min_overlap * available))
+    eligible[target] = False
+    if category is not None: eligible &= self.categories == category
+
+    candidates = np.flatnonzero(eligible)
+    if len(candidates) > k:
+      candidates = candidates[np.argpartition(distances[candidates], k - 1)[:k]]
+    candidates = candidates[np.argsort(distances[candidates], kind='stable')]
+    return pd.DataFrame({
+      'DENOM_CIA': self.companies[candidates],
+      'TIPO': self.categories[candidates],
+      'DISTANCIA': distances[candidates].astype(np.float64),
+      'SOBREPOSICAO': (overlap[candidates] / available).astype(np.float64),
+    })
+
+  def clear(self):
+    with self.lock:
+      self.blocks.clear()
+
+
+if __name__ == '__main__':
+  import sys
+  import time
+
+  import schema
+  import storage
+
+  # Confere contra o cálculo direto em pandas e mede a consulta (uma base maior pode vir como
+  # argumento: python similarity.py benchmarks/data/database_5000x25.csv)
+  data = storage.parse_csv(sys.argv[1]) if len(sys.argv) > 1 else storage.load_data()
+  columns = schema.indicator_columns()
+  groups = {name: group for name, group in schema.get_groups().items() if group}
+  start = time.perf_counter()
+  index = SimilarityIndex(data, columns)
+  built = time.perf_counter() - start
+
+  values = data[columns].astype('float64').replace([np.inf, -np.inf], np.nan)
+  scaled = ((values - values.mean()) / values.std(ddof=0)).clip(-5, 5)
+  scaled[['DENOM_CIA', 'DT_FIM_EXERC']] = data[['DENOM_CIA', 'DT_FIM_EXERC']].astype({'DENOM_CIA': object})
+  scaled = scaled.drop_duplicates(['DENOM_CIA', 'DT_FIM_EXERC'], keep='last')
+  min_year, max_year = int(data['DT_FIM_EXERC'].min()), int(data['DT_FIM_EXERC'].max())
+  rng = np.random.default_rng(0)
+  for name, group in groups.items():
+    company = index.companies[rng.integers(len(index.companies))]
+    low = int(rng.integers(min_year, max_year + 1))
+    result = index.query(company, group, low, max_year, k=5)
+    window = scaled[scaled['DT_FIM_EXERC'].between(low, max_year)]
+    vectors = window.pivot(index='DENOM_CIA', columns='DT_FIM_EXERC', values=group)
+    if company not in vectors.index or vectors.loc[company].isna().all():
+      assert result.empty
+      continue
+    target = vectors.loc[company]
+    differences = (vectors - target) ** 2
+    overlap = differences.notna().sum(axis=1)
+    expected = np.sqrt(differences.sum(axis=1) / overlap)
+    expected = expected[(overlap >= max(1, 0.5 * target.notna().sum())) & (expected.index != company)]
+    expected = expected.sort_values(kind='stable').head(5)
+    np.testing.assert_allclose(result['DISTANCIA'], expected.to_numpy(), rtol=1e-3, atol=1e-4)
+
+  # Por delta: anos nas duas pontas e empresas novas chegam depois e dão o mesmo índice
+  years = data['DT_FIM_EXERC']
+  later = years.isin([years.min(), years.max()]) | data['DENOM_CIA'].isin(index.companies[1::7])
+  incremental = SimilarityIndex(data[~later], columns)
+  start = time.perf_counter()
+  incremental.update(data, data[later])
+  updated = time.perf_counter() - start
+  assert list(incremental.companies) == list(index.companies) and (incremental.first_year, incremental.years) == (index.first_year, index.years)
+  assert list(incremental.categories) == list(index.categories)
+  for group in groups.values():
+    for expected, got in zip(index.block(group), incremental.block(group)):
+      np.testing.assert_allclose(got, expected, rtol=1e-5, atol=1e-6)
+
+  timings = []
+  for group in groups.values():
+    index.query(index.companies[0], group)
+    for company in index.companies[:20]:
+      start = time.perf_counter()
+      index.query(company, group, k=10)
+      timings.append(time.perf_counter() - start)
+  print(f'{len(index.companies)} empresas: índice em {built * 1000:.1f} ms, delta de {int(later.sum())} linhas em {updated * 1000:.1f} ms, consulta mediana {np.median(timings) * 1000:.2f} ms, máxima {max(timings) * 1000:.2f} ms')
@@ -0,0 +1,405 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+import schema
+
+# Trava para acrescentar deltas às colunas compartilhadas; sem fcntl (Windows) fica sem trava
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CSV_PATH = os.path.join(BASE_DIR, 'database.csv')
+STORE_PATH = os.path.join(BASE_DIR, 'database.parquet')
+# Incrementar quando a forma de gerar o parquet mudar
+STORE_VERSION = 2
+KEY_COLUMNS = ['DENOM_CIA', 'DT_FIM_EXERC']
+
+
+def parse_csv(path=CSV_PATH):
+  # Os indicadores vêm com vírgula decimal; o parser converte tudo numa passada só
+  data = pd.read_csv(path, decimal=',', float_precision='round_trip', dtype=schema.read_dtypes())
+  return schema.apply_schema(data.sort_values(by='DT_FIM_EXERC'))
+
+
+def write_csv(data, path):
+  # Mesmo formato do database.csv: vírgula decimal e índices com 10 algarismos significativos
+  data.to_csv(path, index=False, decimal=',', float_format='%.10g')
+
+
+def file_hash(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as file:
+    for chunk in iter(lambda: file.read(1 << 20), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def source_signature(path):
+  stat = os.stat(path)
+  return {'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def read_manifest(store_path):
+  try:
+    with open(f'{store_path}.json') as file:
+      return json.load(file)
+  except (OSError, ValueError):
+    return None
+
+
+def write_manifest(store_path, manifest):
+  tmp_path = f'{store_path}.json.tmp'
+  with open(tmp_path, 'w') as file:
+    json.dump(manifest, file)
+  os.replace(tmp_path, f'{store_path}.json')
+
+
+def deltas_dir(store_path):
+  return f'{store_path}.deltas'
+
+
+def columns_dir(store_path):
+  return f'{store_path}.columns'
+
+
+def is_fresh(csv_path=CSV_PATH, store_path=STORE_PATH):
+  manifest = read_manifest(store_path)
+  if manifest is None or not os.path.exists(store_path):
+    return False
+  if manifest.get('version') != STORE_VERSION or manifest.get('schema') != file_hash(schema.MANIFEST_PATH):
+    return False
+
+  signature = source_signature(csv_path)
+  if manifest['mtime'] == signature['mtime'] and manifest['size'] == signature['size']:
+    return True
+
+  # mtime mudou (ex.: checkout do git) mas o conteúdo pode ser o mesmo
+  if manifest['sha256'] != file_hash(csv_path):
+    return False
+  write_manifest(store_path, {**manifest, **signature})
+  return True
+
+
+def build_store(csv_path=CSV_PATH, store_path=STORE_PATH):
+  data = parse_csv(csv_path)
+  tmp_path = f'{store_path}.tmp'
+  data.to_parquet(tmp_path)
+  os.replace(tmp_path, store_path)
+  # Os deltas já ingeridos continuam valendo por cima do CSV regerado
+  previous = read_manifest(store_path) or {}
+  write_manifest(store_path, {
+    **source_signature(csv_path),
+    'sha256': file_hash(csv_path),
+    'schema': file_hash(schema.MANIFEST_PATH),
+    'version': STORE_VERSION,
+    'rows': len(data),
+    'deltas': previous.get('deltas', []),
+  })
+  return data
+
+
+def dataset_state(csv_path=CSV_PATH, store_path=STORE_PATH):
+  if not is_fresh(csv_path, store_path): build_store(csv_path, store_path)
+  return read_manifest(store_path)
+
+
+def dataset_version(state):
+  return f"{state['sha256'][:12]}+{len(state['deltas'])}"
+
+
+def scope_version(state, category=None, min_year=None, max_year=None):
+  # Quantos deltas tocam o recorte (segmento, anos); chaves de cache com esse número só
+  # mudam quando um delta afeta o que elas mostram
+  touched = 0
+  for delta in state['deltas']:
+    if category is not None and category not in delta['segments']: continue
+    if min_year is not None and delta['years'][1] < min_year: continue
+    if max_year is not None and delta['years'][0] > max_year: continue
+    touched += 1
+  return (state['sha256'][:12], touched)
+
+
+def merge(frames):
+  # Junta sem reprocessar as partes: categóricos ganham a união das categorias e a ordem
+  # por ano só é refeita se algum delta trouxer anos anteriores
+  frames = [frame for frame in frames if len(frame)]
+  if len(frames) == 1: return frames[0]
+  columns = frames[0].select_dtypes('category').columns
+  categories = {column: union_categoricals([frame[column] for frame in frames], sort_categories=True).categories for column in columns}
+  frames = [frame.assign(**{column: frame[column].cat.set_categories(categories[column]) for column in columns}) for frame in frames]
+  data = pd.concat(frames)
+  if not data['DT_FIM_EXERC'].is_monotonic_increasing:
+    data = data.sort_values(by='DT_FIM_EXERC', kind='stable')
+  return data
+
+
+def read_deltas(state, store_path=STORE_PATH, start=0):
+  return [
+    schema.apply_schema(pd.read_parquet(os.path.join(deltas_dir(store_path), delta['part'])))
+    for delta in state['deltas'][start:]
+  ]
+
+
+def load_deltas(start=0, store_path=STORE_PATH):
+  frames = read_deltas(read_manifest(store_path), store_path, start)
+  return merge(frames) if frames else None
+
+
+def validate_delta(path, delta, state, store_path=STORE_PATH):
+  if len(delta) == 0:
+    raise ValueError(f'{path} não tem linhas')
+  for column in ['TIPO', 'DENOM_CIA']:
+    if delta[column].isna().any():
+      raise ValueError(f'{path}: {column} vazio em {int(delta[column].isna().sum())} linhas')
+
+  keys = pd.MultiIndex.from_frame(delta[KEY_COLUMNS].astype({'DENOM_CIA': str}))
+  if keys.has_duplicates:
+    raise ValueError(f'{path}: empresa-ano repetido no delta: {list(keys[keys.duplicated()][:5])}')
+
+  # Só as colunas de chave do que já está no store, e só dos anos que o delta traz
+  years = [int(year) for year in delta['DT_FIM_EXERC'].unique()]
+  stored = [pd.read_parquet(store_path, columns=KEY_COLUMNS, filters=[('DT_FIM_EXERC', 'in', years)])]
+  stored += [frame[KEY_COLUMNS] for frame in read_deltas(state, store_path)]
+  existing = pd.MultiIndex.from_frame(pd.concat(stored).astype({'DENOM_CIA': str}))
+  overlap = keys[keys.isin(existing)]
+  if len(overlap):
+    raise ValueError(f'{path}: {len(overlap)} empresa-ano já existem na base, ex.: {list(overlap[:5])}')
+
+
+def ingest_delta(path, csv_path=CSV_PATH, store_path=STORE_PATH):
+  # Caminho só de acréscimo: valida o delta contra o colunas.json e a base, grava como
+  # uma parte parquet separada e registra no manifesto. A base não é relida nem reprocessada
+  state = dataset_state(csv_path, store_path)
+  digest = file_hash(path)
+  if any(delta['sha256'] == digest for delta in state['deltas']):
+    raise ValueError(f'{path} já foi ingerido')
+
+  manifest = schema.get_manifest()
+  header = list(pd.read_csv(path, nrows=0).columns)
+  missing = [column for column in manifest if column not in header]
+  extra = [column for column in header if column not in manifest]
+  if missing or extra:
+    raise ValueError(f'{path} não segue {schema.MANIFEST_PATH}: faltando {missing}, sobrando {extra}')
+
+  try:
+    delta = parse_csv(path)[list(manifest)]
+  except (TypeError, ValueError) as error:
+    raise ValueError(f'{path}: valores fora do esquema de {schema.MANIFEST_PATH} ({error})') from error
+  validate_delta(path, delta, state, store_path)
+
+  # Índices continuam a numeração da base para não colidir no concat
+  total = state['rows'] + sum(entry['rows'] for entry in state['deltas'])
+  delta.index = pd.RangeIndex(total, total + len(delta))
+
+  part = f'{len(state["deltas"]) + 1:04d}.parquet'
+  os.makedirs(deltas_dir(store_path), exist_ok=True)
+  tmp_path = os.path.join(deltas_dir(store_path), f'{part}.tmp')
+  delta.to_parquet(tmp_path)
+  os.replace(tmp_path, os.path.join(deltas_dir(store_path), part))
+
+  entry = {
+    'part': part,
+    'source': os.path.basename(path),
+    'sha256': digest,
+    'rows': len(delta),
+    'segments': sorted(delta['TIPO'].astype(str).unique()),
+    'years': [int(delta['DT_FIM_EXERC'].min()), int(delta['DT_FIM_EXERC'].max())],
+  }
+  write_manifest(store_path, {**state, 'deltas': state['deltas'] + [entry]})
+  return entry
+
+
+def load_data(csv_path=CSV_PATH, store_path=STORE_PATH, float32=False):
+  if is_fresh(csv_path, store_path):
+    data = pd.read_parquet(store_path)
+  else:
+    data = build_store(csv_path, store_path)
+  data = merge([data, *read_deltas(read_manifest(store_path), store_path)])
+  return schema.apply_schema(data, float32=True) if float32 else data
+
+
+def codes_dtype(categories):
+  # O menor inteiro que o pandas usa para os códigos; com outro tipo o from_codes copiaria a coluna
+  for dtype in (np.int8, np.int16, np.int32):
+    if categories < np.iinfo(dtype).max: return np.dtype(dtype)
+  return np.dtype(np.int64)
+
+
+def column_array(values, categories=None):
+  if categories is None: return values.to_numpy()
+  return pd.Categorical(values, categories=categories).codes.astype(codes_dtype(len(categories)))
+
+
+def read_layout(directory):
+  with open(os.path.join(directory, 'colunas.json'), encoding='utf-8') as file:
+    return json.load(file)
+
+
+def write_layout(directory, layout):
+  tmp_path = os.path.join(directory, f'colunas.json.tmp-{os.getpid()}')
+  with open(tmp_path, 'w', encoding='utf-8') as file:
+    json.dump(layout, file, ensure_ascii=False)
+  os.replace(tmp_path, os.path.join(directory, 'colunas.json'))
+
+
+def export_columns(data, directory):
+  # Uma coluna por arquivo binário cru (categóricos como códigos; categorias e tipos no colunas.json
+  # da pasta). Os deltas entram depois por append_columns, no fim dos mesmos arquivos
+  tmp_path = f'{directory}.tmp-{os.getpid()}'
+  os.makedirs(tmp_path)
+  columns = []
+  for i, column in enumerate(data.columns):
+    values = data[column]
+    categories = list(values.cat.categories) if isinstance(values.dtype, pd.CategoricalDtype) else None
+    array = column_array(values, categories)
+    array.tofile(os.path.join(tmp_path, f'{i}.bin'))
+    columns.append({'name': column, 'file': f'{i}.bin', 'dtype': array.dtype.str, 'categories': categories, 'sizes': [len(categories)] if categories is not None else None})
+  index = data.index.to_numpy()
+  index.tofile(os.path.join(tmp_path, 'index.bin'))
+  # rows e sizes: linhas e número de categorias com 0, 1, 2... deltas aplicados
+  write_layout(tmp_path, {'rows': [len(data)], 'parts': [], 'index': index.dtype.str, 'columns': columns})
+  try:
+    os.rename(tmp_path, directory)
+  except OSError:
+    # Outro processo exportou a mesma base primeiro
+    shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def append_columns(directory, frame, part):
+  # Acrescenta as linhas de um delta ao fim dos arquivos, com a pasta travada. Quem já mapeou a
+  # pasta lê só as linhas que o colunas.json tinha quando abriu; o que vem depois não o afeta
+  with open(os.path.join(directory, 'lock'), 'w') as lock:
+    if fcntl is not None: fcntl.flock(lock, fcntl.LOCK_EX)
+    layout = read_layout(directory)
+    if part in layout['parts']: return
+    rows = layout['rows'][-1]
+    for i, column in enumerate(layout['columns']):
+      values = frame[column['name']]
+      categories = column['categories']
+      if categories is not None:
+        known = set(categories)
+        categories = categories + [value for value in values.cat.categories if value not in known]
+      array = column_array(values, categories)
+      dtype = np.promote_types(np.dtype(column['dtype']), array.dtype)
+      path = os.path.join(directory, column['file'])
+      if dtype != np.dtype(column['dtype']):
+        # O delta não cabe no tipo da coluna (ex.: lacuna numa coluna inteira, mais categorias do que
+        # os códigos comportam): só essa coluna é regravada, num arquivo novo; o antigo fica para quem
+        # ainda o tem mapeado
+        previous = np.fromfile(path, dtype=column['dtype'], count=rows)
+        column.update(file=f'{i}-{len(layout["parts"]) + 1}.bin', dtype=dtype.str)
+        path = os.path.join(directory, column['file'])
+        previous.astype(dtype).tofile(path)
+      with open(path, 'r+b') as file:
+        # Descarta o que sobrou de uma gravação interrompida depois da última linha registrada
+        file.truncate(rows * dtype.itemsize)
+        file.seek(0, os.SEEK_END)
+        file.write(array.astype(dtype, copy=False).tobytes())
+      if categories is not None:
+        column['categories'] = categories
+        column['sizes'].append(len(categories))
+    with open(os.path.join(directory, 'index.bin'), 'r+b') as file:
+      file.truncate(rows * np.dtype(layout['index']).itemsize)
+      file.seek(0, os.SEEK_END)
+      file.write(frame.index.to_numpy().astype(layout['index']).tobytes())
+    layout['parts'].append(part)
+    layout['rows'].append(rows + len(frame))
+    write_layout(directory, layout)
+
+
+def open_columns(directory, parts=None):
+  # DataFrame sobre os arquivos mapeados em memória, só leitura e sem cópia: cada coluna fica no
+  # seu bloco (copy=False não consolida) e as páginas vêm do cache do sistema, compartilhadas por
+  # todas as sessões e processos do host. parts: quantos deltas entram (padrão: todos os da pasta)
+  layout = read_layout(directory)
+  parts = len(layout['parts']) if parts is None else parts
+  rows = layout['rows'][parts]
+  arrays = {}
+  for column in layout['columns']:
+    values = np.memmap(os.path.join(directory, column['file']), dtype=column['dtype'], mode='r', shape=(rows,))
+    if column['categories'] is not None:
+      # Só as categorias que já existiam nesta versão; com deltas, em ordem alfabética como no merge
+      categories = column['categories'][:column['sizes'][parts]]
+      values = pd.Categorical.from_codes(values, dtype=pd.CategoricalDtype(categories), validate=False)
+      if parts and categories != sorted(categories): values = values.reorder_categories(sorted(categories))
+    arrays[column['name']] = values
+  index = pd.Index(np.memmap(os.path.join(directory, 'index.bin'), dtype=layout['index'], mode='r', shape=(rows,)))
+  data = pd.DataFrame(arrays, index=index, copy=False)
+  # Delta com anos anteriores aos da base: reordena por ano como o load_data (esta versão deixa de
+  # ser compartilhada, cada processo fica com uma cópia)
+  if not data['DT_FIM_EXERC'].is_monotonic_increasing:
+    data = data.take(np.argsort(data['DT_FIM_EXERC'].to_numpy(), kind='stable'))
+  return data
+
+
+def load_shared(csv_path=CSV_PATH, store_path=STORE_PATH, float32=False):
+  # Mesmo conteúdo do load_data, mas compartilhado. As colunas da base são exportadas uma vez por
+  # CSV; cada delta novo só é lido e acrescentado no fim delas. Quem chega depois (em qualquer
+  # processo) só mapeia os arquivos
+  state = dataset_state(csv_path, store_path)
+  name = f"{state['sha256'][:12]}-float32" if float32 else state['sha256'][:12]
+  directory = os.path.join(columns_dir(store_path), name)
+  if not os.path.exists(os.path.join(directory, 'colunas.json')):
+    os.makedirs(columns_dir(store_path), exist_ok=True)
+    base = pd.read_parquet(store_path)
+    export_columns(schema.apply_schema(base, float32=True) if float32 else base, directory)
+    # Bases antigas saem do disco; quem ainda as tem mapeadas continua lendo até soltar
+    for other in os.listdir(columns_dir(store_path)):
+      if other not in (state['sha256'][:12], f"{state['sha256'][:12]}-float32") and '.tmp-' not in other:
+        shutil.rmtree(os.path.join(columns_dir(store_path), other), ignore_errors=True)
+
+  applied = read_layout(directory)['parts']
+  for delta in state['deltas'][len(applied):]:
+    frame = schema.apply_schema(pd.read_parquet(os.path.join(deltas_dir(store_path), delta['part'])), float32=float32)
+    append_columns(directory, frame, delta['part'])
+  return open_columns(directory, len(state['deltas']))
+
+
+def select_rows(data, category=None, min_year=None, max_year=None, companies=None, categories=None):
+  # Posições das linhas do recorte, sem materializar nada. Com o dataset ordenado por ano o
+  # intervalo vira um slice por busca binária e só ele passa pelos outros filtros
+  years = data['DT_FIM_EXERC'].to_numpy()
+  start, end = 0, len(years)
+  mask = None
+  if data['DT_FIM_EXERC'].is_monotonic_increasing:
+    if min_year is not None: start = int(np.searchsorted(years, min_year, side='left'))
+    if max_year is not None: end = int(np.searchsorted(years, max_year, side='right'))
+    end = max(start, end)
+  else:
+    mask = np.ones(len(years), dtype=bool)
+    if min_year is not None: mask &= years >= min_year
+    if max_year is not None: mask &= years <= max_year
+
+  window = data.iloc[start:end]
+  if mask is None: mask = np.ones(end - start, dtype=bool)
+  if category is not None: mask &= (window['TIPO'] == category).to_numpy()
+  if categories: mask &= window['TIPO'].isin(categories).to_numpy()
+  if companies: mask &= window['DENOM_CIA'].isin(companies).to_numpy()
+  return start + np.flatnonzero(mask)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Gera o database.parquet a partir do CSV e ingere deltas com novos anos')
+  parser.add_argument('--delta', nargs='*', default=[], help='CSVs com linhas empresa-ano novas, no mesmo formato do database.csv')
+  args = parser.parse_args()
+
+  if not args.delta:
+    build_store()
+    print(f'{STORE_PATH} gerado a partir de {CSV_PATH}')
+    load_shared()
+  for path in args.delta:
+    entry = ingest_delta(path)
+    print(f"{path}: {entry['rows']} linhas, anos {entry['years'][0]}-{entry['years'][1]}, segmentos {', '.join(entry['segments'])}")
+
+
+if __name__ == '__main__':
+  main()